@@ -1,25 +1,51 @@
 # Import operating system and regular expression libraries for this chunk
 import os, re
+import threading
+import hashlib
+import numpy as np
+
+
+# Error for mainboard ids missing from the nickname file
+class UnknownMBIDError(LookupError):
+    def __init__(self, mbids):
+        self.mbids = list(mbids)
+        message = "Mainboard id(s) not in nickname file: "+\
+                  ", ".join(["%12.12x" % mbid for mbid in self.mbids[:10]])
+        if len(self.mbids)>10:
+            message += " (and "+str(len(self.mbids)-10)+" more)"
+        LookupError.__init__(self, message)
+
+    def __reduce__(self):
+        # Lets the error be pickled (e.g. from a worker process)
+        return (UnknownMBIDError, (self.mbids,))
 
 # Class for pulling the names and other information of doms based on their keys
 class Nicknames:
-    def __init__(self, filename):
-        pattern = re.compile('([0-9a-f]{12})\s+(\w{8})\s+(\w+)\s+([0-9A-Z]{2}\-[0-9]{2}).*')
+    # Kinds of keys, in the order of the entries of domdb
+    fields = ('mbid', 'domid', 'name', 'loc')
+
+    def __init__(self, filename, cache_dir=None):
+        """
+        Load the nickname file.  If a cache directory is given, the parsed
+        file is kept there in binary form and reused while the file is
+        unchanged.
+        """
         self.mpat = re.compile('[0-9a-f]{12}')
         self.dpat = re.compile('([ATUX][EP][0-9][HPY][0-9]{4})')
         self.lpat = re.compile('\w{2}\-[0-9]{2}')
-        f = open(filename)
+        self.domdb = None
+        if cache_dir is not None:
+            cachefile = self._cache_name(filename, cache_dir)
+            self.domdb = self._read_cache(filename, cachefile)
+        if self.domdb is None:
+            self.domdb = self._parse(filename)
+            if cache_dir is not None:
+                self._write_cache(filename, cachefile)
+
         self.by_mbid  = dict()
         self.by_domid = dict()
         self.by_name  = dict()
         self.by_loc   = dict()
-        self.domdb    = [ ]
-        while 1:
-            s = f.readline()
-            if len(s) == 0: break
-            m = pattern.match(s)
-            if m is not None: self.domdb.append(m.groups())
-        f.close()
         for index in range(len(self.domdb)):
             mbid, domid, name, loc = self.domdb[index]
             self.by_mbid[mbid] = index
@@ -27,6 +53,100 @@ class Nicknames:
             self.by_name[name] = index
             self.by_loc[loc] = index
 
+        # Each kind of key sorted, with the domdb index of each, for looking
+        # up arrays of keys all at once
+        self.sorted_keys = dict()
+        self.sorted_index = dict()
+        for i, field in enumerate(self.fields):
+            keys = np.array([dom[i] for dom in self.domdb], dtype=object)
+            order = np.argsort(keys, kind='mergesort')
+            self.sorted_keys[field] = keys[order]
+            self.sorted_index[field] = order
+
+        # Tables sorted by integer mbid, for translating arrays of mbids to
+        # locations all at once. Locations not of the form string-om get
+        # string number -1
+        mbids = np.array([int(dom[0], 16) for dom in self.domdb],
+                         dtype=np.int64)
+        order = np.argsort(mbids)
+        self.mbid_table = mbids[order]
+        self.loc_table = np.array([self.domdb[i][3] for i in order],
+                                  dtype=object)
+        self.string_table = np.array([self._loc_int(loc[0:2])
+                                      for loc in self.loc_table], dtype=np.int8)
+        self.om_table = np.array([self._loc_int(loc[3:5])
+                                  for loc in self.loc_table], dtype=np.int8)
+
+    @staticmethod
+    def _parse(filename):
+        pattern = re.compile('([0-9a-f]{12})\s+(\w{8})\s+(\w+)\s+([0-9A-Z]{2}\-[0-9]{2}).*')
+        domdb = [ ]
+        f = open(filename)
+        while 1:
+            s = f.readline()
+            if len(s) == 0: break
+            m = pattern.match(s)
+            if m is not None: domdb.append(m.groups())
+        f.close()
+        return domdb
+
+    @staticmethod
+    def _cache_name(filename, cache_dir):
+        # One cache file per nickname file path
+        path = os.path.abspath(filename)
+        return os.path.join(cache_dir, os.path.basename(path)+"-"+
+                            hashlib.md5(path).hexdigest()[:12]+".npz")
+
+    @staticmethod
+    def _file_hash(filename):
+        with open(filename, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def _read_cache(self, filename, cachefile):
+        # Returns domdb from the cache file, or None if there is no cache
+        # matching the current nickname file
+        if not os.path.isfile(cachefile):
+            return None
+        try:
+            cache = np.load(cachefile)
+            try:
+                stat = os.stat(filename)
+                if (int(cache['size'])!=stat.st_size or
+                    float(cache['mtime'])!=stat.st_mtime) and \
+                   str(cache['md5'])!=self._file_hash(filename):
+                    return None
+                columns = [cache[field].tolist() for field in self.fields]
+            finally:
+                cache.close()
+        except Exception:
+            # Unreadable cache is just parsed again
+            return None
+        return list(zip(*columns))
+
+    def _write_cache(self, filename, cachefile):
+        # Failing to write the cache only costs parsing again next time
+        stat = os.stat(filename)
+        columns = dict()
+        for i, field in enumerate(self.fields):
+            columns[field] = np.array([dom[i] for dom in self.domdb],
+                                      dtype=str)
+        tempfile = cachefile[:-4]+"-"+str(os.getpid())+".npz"
+        try:
+            if not os.path.isdir(os.path.dirname(cachefile)):
+                os.makedirs(os.path.dirname(cachefile))
+            np.savez(tempfile, size=stat.st_size, mtime=stat.st_mtime,
+                     md5=self._file_hash(filename), **columns)
+            os.rename(tempfile, cachefile)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _loc_int(part):
+        try:
+            return int(part)
+        except ValueError:
+            return -1
+
     def lookup(self, key):
         """
         Do a smart lookup of a DOM.  It knows what you are asking.
@@ -41,10 +161,72 @@ class Nicknames:
         else:
             return self.domdb[self.by_name[key]]
 
+    def indices(self, keys, field='mbid'):
+        """
+        Look up an array of keys of one kind (mbid, domid, name, or loc),
+        returning an array of their indices in domdb.  Raises KeyError
+        listing any missing keys.
+        """
+        sorted_keys = self.sorted_keys[field]
+        keys = np.asarray(keys, dtype=object)
+        index = np.searchsorted(sorted_keys, keys)
+        index[index>=len(sorted_keys)] = 0
+        if len(sorted_keys)==0:
+            found = np.zeros(len(keys), dtype=bool)
+        else:
+            found = sorted_keys[index]==keys
+        if not np.all(found):
+            missing = sorted(set(keys[~found].tolist()))
+            raise KeyError(field+"(s) not in nickname file: "+
+                           ", ".join(missing[:10]))
+        return self.sorted_index[field][index]
+
+    def translate(self, mbids):
+        """
+        Translate an array of integer mbids to arrays of locations, string
+        numbers, and om numbers.  Raises UnknownMBIDError for missing mbids.
+        """
+        mbids = np.asarray(mbids, dtype=np.int64)
+        if len(self.mbid_table)==0:
+            raise UnknownMBIDError(np.unique(mbids).tolist())
+        index = np.searchsorted(self.mbid_table, mbids)
+        index[index>=len(self.mbid_table)] = 0
+        found = self.mbid_table[index]==mbids
+        if not np.all(found):
+            raise UnknownMBIDError(np.unique(mbids[~found]).tolist())
+        return (self.loc_table[index], self.string_table[index],
+                self.om_table[index])
+
+
+# Location of the nickname file to pull DOM information from, and of the
+# binary cache of it. Both can be set by environment variables, or changed
+# with set_nickname_file. The file isn't read until the first lookup
+nickname_file = os.environ.get('DAQ_NICKNAMES', '/home/fasig/nicknames.txt')
+nickname_cache_dir = os.environ.get('DAQ_NICKNAMES_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'daq_nicknames'))
+nickdef = None
+nickdef_lock = threading.Lock()
+
+def set_nickname_file(filename, cache_dir=None):
+    global nickname_file, nickname_cache_dir, nickdef
+    nickname_file = filename
+    if cache_dir is not None:
+        nickname_cache_dir = cache_dir
+    nickdef = None
 
-# Location of the nickname file to pull DOM information from
-nickdef = Nicknames('/home/fasig/nicknames.txt')
+def get_nicknames():
+    global nickdef
+    # Threads decoding hubs at once load the file only once
+    with nickdef_lock:
+        if nickdef is None:
+            nickdef = Nicknames(nickname_file, nickname_cache_dir)
+    return nickdef
 
 def lookup(key):
-    if nickdef is None: return None
-    return nickdef.lookup(key)
+    return get_nicknames().lookup(key)
+
+def indices(keys, field='mbid'):
+    return get_nicknames().indices(keys, field)
+
+def translate(mbids):
+    return get_nicknames().translate(mbids)
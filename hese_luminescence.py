@@ -53,7 +53,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 # Custom libraries
-from hsreader import load_stream
+from hsreader import load_stream, PulseDetector, EventHistograms, find_events
 
 
 # # Function for writing log statements
@@ -79,25 +79,22 @@ from hsreader import load_stream
 #           logfilename)
 
 
-# Bin hits to a histogram with microsecond bins
-hit_stream = load_stream(datadir,keyword=filekeyword)
+# Bin hits with microsecond bins to find events, taking all bins with 80% or
+# more of the hits in the bin with the most hits. Histograms after each
+# candidate event are filled in the same pass over the hits, ignoring DOMs
+# that have been hit more than once in the first 32 microseconds
 bin_width = 10000
-n_bins = 1000000*filelength
-histo = np.zeros(n_bins,'d')
-t0 = None
+lum_bin_width = 10000
+lum_n_bins = 1000
+lum_time_window = lum_n_bins*lum_bin_width
+hit_stream = load_stream(datadir,keyword=filekeyword,block_size=100000)
+detector = PulseDetector(bin_width,fraction=.8)
+lum = EventHistograms([],lum_time_window,lum_bin_width,dead_window=320000)
 print("Finding fullest bins")
-for hit in hit_stream:
-    if t0==None:
-        t0 = hit.utc
-    dt = hit.utc-t0
-    time_index = int(dt/bin_width)
-    histo[time_index] += 1
-
-
-# Find all bins with 90% or more of the hits in the bin with the most hits
-maximum = np.max(histo)
-mean = np.mean(histo)
-pulse_bins = [i for i in range(len(histo)) if histo[i]>=.8*maximum]
+event_times, event_counts = find_events(hit_stream,detector,lum)
+event_indices = np.searchsorted(lum.event_times,event_times)
+mean = detector.total/(1000000*filelength)
+mean = mean*lum_bin_width/bin_width
 
 
 # Function for creating plot of luminescence data
@@ -115,57 +112,11 @@ def luminescence_plot(data,title="plot",extra_text=None):
     # plt.show()
 
 
-# Plot hits after an event
-# Ignore DOMs that have been hit more than once in the first 12 microseconds
-hit_stream = load_stream(datadir,keyword=filekeyword,reuse_data=True)
-for i in range(len(pulse_bins)):
-    print("Plotting",i+1,"of",len(pulse_bins))
-    event_time = t0+pulse_bins[i]*bin_width
-    lum_bin_width = 10000
-    lum_n_bins = 1000
-    lum_time_window = lum_n_bins*lum_bin_width
-    mean = mean*lum_bin_width/bin_width
-
-    # Get to the event in the hit stream
-    hit = hit_stream.next()
-    if hit.utc>event_time:
-        hit_stream = load_stream(datadir,keyword=filekeyword,reuse_data=True)
-        hit = hit_stream.next()
-    while hit.utc<event_time:
-        hit = hit_stream.next()
-
-    # Find any DOMs hit twice in the first 32 microseconds
-    hit_doms = []
-    dead_doms = []
-    lum_data = np.zeros(lum_n_bins,'d')
-    while hit.utc<event_time+320000:
-        if hit.omkey in hit_doms:
-            dead_doms.append(hit.omkey)
-        else:
-            hit_doms.append(hit.omkey)
-        # dt = hit.utc-event_time
-        # time_index = int(dt/lum_bin_width)
-        # lum_data[time_index] += 1
-        hit = hit_stream.next()
-
-    # Get to the event in the hit stream again
-    if hit.utc>event_time:
-        hit_stream = load_stream(datadir,keyword=filekeyword,reuse_data=True)
-        hit = hit_stream.next()
-    while hit.utc<event_time:
-        hit = hit_stream.next()
-
-    # Create histogram, excluding the dead DOMs
-    while hit.utc<event_time+lum_time_window:
-        if hit.omkey in dead_doms:
-            hit = hit_stream.next()
-            continue
-        dt = hit.utc-event_time
-        time_index = int(dt/lum_bin_width)
-        lum_data[time_index] += 1
-        hit = hit_stream.next()
-
-    luminescence_plot(lum_data,title=filekeyword+" "+str(i+1),
-                      extra_text=str(len(dead_doms))+" DOMs ignored\n"+\
-                                 str(int(histo[pulse_bins[i]]))+\
+# Plot hits after each event
+for i in range(len(event_times)):
+    print("Plotting",i+1,"of",len(event_times))
+    j = event_indices[i]
+    luminescence_plot(lum.histograms[j],title=filekeyword+" "+str(i+1),
+                      extra_text=str(lum.dead_masks[j].sum())+" DOMs ignored\n"+\
+                                 str(int(event_counts[i]))+\
                                  " hits in event bin")
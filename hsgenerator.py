@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+#
+# hsgenerator.py
+# Library and script for writing synthetic hitspool data (hitspool files,
+# nickname file, and optionally the hub tarfile layout) for testing and
+# benchmarking hsreader
+#
+#
+# Ben Hokanson-Fasig
+# Created   10/17/26
+# Last edit 10/17/26
+#
+
+from __future__ import division, print_function
+import os, os.path
+import shutil, tarfile, tempfile
+import numpy as np
+from hsreader import HEADER_SIZE, raw_dtype, DOMS_PER_STRING
+
+
+# Hit times are in units of 0.1 ns
+UTC_PER_SECOND = 10**10
+
+
+def make_doms(n_hubs, rng):
+    """Returns list of DOM tuples (mbid, domid, name, loc) for DOMs 1-60 of
+    strings 1 to n_hubs, with random unique mainboard ids"""
+    doms = []
+    mbids = set()
+    for hub in range(1, n_hubs+1):
+        for om in range(1, DOMS_PER_STRING+1):
+            mbid = int(rng.randint(1, 2**48, dtype=np.int64))
+            while mbid in mbids:
+                mbid = int(rng.randint(1, 2**48, dtype=np.int64))
+            mbids.add(mbid)
+            index = (hub-1)*DOMS_PER_STRING+om
+            doms.append(("%12.12x" % mbid, "TP0H%04d" % index,
+                         "Synth_%02d_%02d" % (hub, om),
+                         "%02d-%02d" % (hub, om)))
+    return doms
+
+
+def write_nickname_file(filename, doms):
+    """Writes nickname file for DOM tuples (mbid, domid, name, loc)"""
+    with open(filename, 'w') as f:
+        f.write("mbid         domid    name               loc\n")
+        for dom in doms:
+            f.write("%s %s %-18s %s\n" % dom)
+
+
+def hub_hits(mbids, start, duration, rate, rng, pulses=(), pulse_hits=0,
+             pulse_width=10000):
+    """Returns time-sorted arrays of the times and mbids of random hits of a
+    hub's DOMs (by mbid) from start over duration (in utc units), at rate
+    hits per second per DOM. Each pulse time adds pulse_hits hits to the hub
+    within pulse_width after it"""
+    mbids = np.asarray(mbids, dtype=np.int64)
+    n = rng.poisson(rate*len(mbids)*duration/UTC_PER_SECOND)
+    utcs = [start+rng.randint(0, duration, n, dtype=np.int64)]
+    doms = [rng.randint(0, len(mbids), n)]
+    for pulse in pulses:
+        utcs.append(pulse+rng.randint(0, pulse_width, pulse_hits,
+                                      dtype=np.int64))
+        doms.append(rng.randint(0, len(mbids), pulse_hits))
+    utcs = np.concatenate(utcs)
+    doms = np.concatenate(doms)
+    order = np.argsort(utcs, kind='mergesort')
+    return utcs[order], mbids[doms[order]]
+
+
+def write_records(f, utcs, mbids, rng, max_payload=40, chunk_size=1<<16):
+    """Writes hitspool records for hits (arrays of times and mbids) to open
+    file f, with random control words and payloads of up to max_payload
+    bytes"""
+    for first in range(0, len(utcs), chunk_size):
+        last = min(first+chunk_size, len(utcs))
+        n = last-first
+        headers = np.zeros(n, dtype=raw_dtype)
+        headers['recl'] = HEADER_SIZE+rng.randint(0, max_payload+1, n)
+        headers['rtyp'] = 2
+        headers['mbid'] = mbids[first:last]
+        headers['utc'] = utcs[first:last]
+        headers['unite'] = 1
+        headers['ver'] = 2
+        headers['domclk'] = utcs[first:last]//250
+        headers['w1'] = rng.randint(0, 2**32, n, dtype=np.uint32)
+        headers['w3'] = rng.randint(0, 2**32, n, dtype=np.uint32)
+
+        # Random payload bytes, with the headers written over the beginning
+        # of each record
+        recls = headers['recl'].astype(np.int64)
+        buf = rng.randint(0, 256, recls.sum()).astype(np.uint8)
+        offsets = np.cumsum(recls)-recls
+        buf[offsets[:,np.newaxis]+np.arange(HEADER_SIZE)] = \
+            headers.view(np.uint8).reshape(n, HEADER_SIZE)
+        f.write(buf.tostring())
+
+
+def write_hub(directory, mbids, start, duration, rate, rng, n_files=4,
+              pulses=(), pulse_hits=0, max_payload=40):
+    """Writes hitspool files HitSpool-N.dat of a hub's random hits (see
+    hub_hits) to directory, splitting the time span evenly between n_files
+    files. Returns number of hits written"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    utcs, hit_mbids = hub_hits(mbids, start, duration, rate, rng, pulses,
+                               pulse_hits)
+    bounds = np.searchsorted(utcs, start+np.arange(n_files+1)*duration
+                             //n_files)
+    bounds[-1] = len(utcs)
+    for i in range(n_files):
+        with open(os.path.join(directory, "HitSpool-"+str(i)+".dat"),
+                  'wb') as f:
+            write_records(f, utcs[bounds[i]:bounds[i+1]],
+                          hit_mbids[bounds[i]:bounds[i+1]], rng, max_payload)
+    return len(utcs)
+
+
+def pack_hub(hubdir, destination, name):
+    """Packs hitspool directory into the hub tarfile layout, as
+    destination/name.tar.gz holding name.meta.xml and name.tar.bz2 (which
+    holds the hitspool files in directory name). Returns path of the tarfile"""
+    workdir = tempfile.mkdtemp(dir=destination)
+    try:
+        bzfile = os.path.join(workdir, name+".tar.bz2")
+        bz = tarfile.open(bzfile, 'w:bz2')
+        bz.add(hubdir, arcname=name, recursive=False)
+        for item in sorted(os.listdir(hubdir)):
+            bz.add(os.path.join(hubdir, item), arcname=name+"/"+item)
+        bz.close()
+        xmlfile = os.path.join(workdir, name+".meta.xml")
+        with open(xmlfile, 'w') as f:
+            f.write("<?xml version=\"1.0\"?>\n<DIF_Plus></DIF_Plus>\n")
+        gzfile = os.path.join(destination, name+".tar.gz")
+        gz = tarfile.open(gzfile, 'w:gz')
+        gz.add(xmlfile, arcname=name+".meta.xml")
+        gz.add(bzfile, arcname=name+".tar.bz2")
+        gz.close()
+    finally:
+        shutil.rmtree(workdir)
+    return gzfile
+
+
+def generate_spool(destination, n_hubs=4, duration=1.0, rate=500.0,
+                   start=10**16, n_files=4, seed=0, pulses=(), pulse_hits=0,
+                   max_payload=40, pack=False, tag="20161027_HESE",
+                   nickname_file=None):
+    """Writes a synthetic spool of n_hubs hubs (strings 1 to n_hubs) with
+    random hits at rate hits per second per DOM for duration seconds from
+    start, plus pulse_hits hits per hub at each pulse time. Each hub is
+    written to hitspool directory destination/ichubXX_tag, or if pack to
+    hub tarfile destination/ichubXX_tag.tar.gz. The matching nickname file
+    is written to nickname_file (defaults to destination/nicknames.txt).
+    Returns list of the hub directories (or tarfiles), and the number of
+    hits written"""
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    if nickname_file is None:
+        nickname_file = os.path.join(destination, "nicknames.txt")
+    rng = np.random.RandomState(seed)
+    doms = make_doms(n_hubs, rng)
+    write_nickname_file(nickname_file, doms)
+
+    span = int(duration*UTC_PER_SECOND)
+    paths = []
+    n_hits = 0
+    for hub in range(1, n_hubs+1):
+        name = "ichub%02d_%s" % (hub, tag)
+        mbids = [int(dom[0], 16) for dom in
+                 doms[(hub-1)*DOMS_PER_STRING:hub*DOMS_PER_STRING]]
+        if pack:
+            hubdir = tempfile.mkdtemp(dir=destination)
+        else:
+            hubdir = os.path.join(destination, name)
+        try:
+            n_hits += write_hub(hubdir, mbids, start, span, rate, rng,
+                                n_files, pulses, pulse_hits, max_payload)
+            if pack:
+                paths.append(pack_hub(hubdir, destination, name))
+            else:
+                paths.append(hubdir)
+        finally:
+            if pack:
+                shutil.rmtree(hubdir)
+    return paths, n_hits
+
+
+if __name__=="__main__":
+    import argparse
+
+    parser_desc = """Script for writing a synthetic hitspool spool"""
+    parser_ep = """Note that this script depends on the standard python
+                   libraries os, shutil, tarfile, tempfile, numpy; and the
+                   custom library hsreader"""
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description=parser_desc,
+                                     epilog=parser_ep)
+    parser.add_argument('destination',
+                        help="directory in which to write the spool")
+    parser.add_argument('-n', '--hubs', default=4, type=int,
+                        help="""number of hubs (default is 4)""")
+    parser.add_argument('-r', '--rate', default=500., type=float,
+                        help="""hit rate of each DOM in Hz (default is
+                        500)""")
+    parser.add_argument('-t', '--time', default=1., type=float,
+                        help="""length of the spool in seconds (default is
+                        1s)""")
+    parser.add_argument('-f', '--files', default=4, type=int,
+                        help="""number of hitspool files per hub (default is
+                        4)""")
+    parser.add_argument('-s', '--seed', default=0, type=int,
+                        help="""random seed (default is 0)""")
+    parser.add_argument('-p', '--pulse', action='append', type=float,
+                        default=[],
+                        help="""time in seconds from the start of the spool
+                        of a pulse of hits (can be given more than once)""")
+    parser.add_argument('--pulse-hits', default=1000, type=int,
+                        help="""hits per hub in each pulse (default is
+                        1000)""")
+    parser.add_argument('--pack', action='store_true',
+                        help="""pack each hub into the ichub*.tar.gz hub
+                        tarfile layout""")
+    parser.add_argument('-k', '--keyword', default='20161027_HESE',
+                        help="""tag in the hub names (default is
+                        20161027_HESE)""")
+    parser.add_argument('--nicknames',
+                        help="""nickname file to write (default is
+                        nicknames.txt in the destination)""")
+    args = parser.parse_args()
+
+    start = 10**16
+    pulses = [start+int(pulse*UTC_PER_SECOND) for pulse in args.pulse]
+    paths, n_hits = generate_spool(args.destination, args.hubs, args.time,
+                                   args.rate, start, args.files, args.seed,
+                                   pulses, args.pulse_hits, pack=args.pack,
+                                   tag=args.keyword,
+                                   nickname_file=args.nicknames)
+    print("Wrote", n_hits, "hits in", len(paths), "hubs to", args.destination)
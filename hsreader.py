@@ -10,148 +10,2234 @@
 #
 
 from __future__ import division, print_function
-from struct import unpack
-from daq_nicknames import lookup
+from struct import Struct, unpack_from
+from daq_nicknames import translate
 import numpy as np
-import sys, os, os.path
+from numpy.lib.stride_tricks import as_strided
+import sys, os, os.path, time
+import collections, heapq, io, mmap, re, tarfile
+import hashlib, json, multiprocessing, shutil, subprocess
+import atexit, Queue, threading, weakref
 
 
-class Hit:
-    """Hit object with attributes"""
-    # Clean up if possible
+# Layout of the 54-byte header at the start of each hitspool record
+# (same as ">iiq8xq3hq2i", but with the control words unsigned)
+HEADER_SIZE = 54
+raw_dtype = np.dtype([('recl','>i4'), ('rtyp','>i4'), ('mbid','>i8'),
+                      ('pad','V8'), ('utc','>i8'), ('unite','>i2'),
+                      ('ver','>i2'), ('fpq','>i2'), ('domclk','>i8'),
+                      ('w1','>u4'), ('w3','>u4')])
+_recl_struct = Struct(">i")
+
+# Decoded hits, with the fields of Hit computed for every record
+hit_dtype = np.dtype([('utc','i8'), ('mbid','i8'), ('string','i1'),
+                      ('om','i1'), ('dom','u2'), ('w1','u4'), ('w3','u4'),
+                      ('lc','u1'), ('min_bias','?'), ('trigmask','u2'),
+                      ('fadc','?'), ('atwd','?'), ('aorb','u1'),
+                      ('charge_pos','i2'), ('charge_pre','i2'),
+                      ('charge_max','i2'), ('charge_pst','i2'),
+                      ('hit_size','u2')])
+
+# Dense index of the in-ice DOMs, (string-1)*60+(om-1), used for per-DOM
+# arrays of counts and masks. DOMs off the in-ice grid get index N_DOMS
+N_STRINGS = 86
+DOMS_PER_STRING = 60
+N_DOMS = N_STRINGS*DOMS_PER_STRING
+
+# Compact hits returned by load as arrays, with the DOM as its dense index
+# and the single bit fields packed into flags (lc in the lowest two bits)
+compact_dtype = np.dtype([('utc','i8'), ('dom','u2'), ('flags','u1'),
+                          ('trigmask','u2'), ('hit_size','u2'),
+                          ('charge_pos','u1'), ('charge_pre','i2'),
+                          ('charge_max','i2'), ('charge_pst','i2')])
+FLAG_LC = 0x03
+FLAG_MIN_BIAS = 0x04
+FLAG_FADC = 0x08
+FLAG_ATWD = 0x10
+FLAG_AORB = 0x20
+
+# Rows of the hits table written by write_h5
+h5_dtype = np.dtype([('omkey','S8'), ('hub_num','i1'), ('dom_num','i1'),
+                     ('utc','i8'), ('lc','i1'), ('min_bias','?'),
+                     ('trigmask','i2'), ('dig_info','S8'), ('aorb','u1'),
+                     ('charge_pos','i2'), ('charge_pre','i2'),
+                     ('charge_max','i2'), ('charge_pst','i2'),
+                     ('hit_size','i2')])
+
+
+class Hit(object):
+    """Hit object with attributes. All attributes are decoded once when the
+    hit is made, and stored in slots to keep hits small"""
+    __slots__ = ('omkey', 'hub_num', 'dom_num', 'utc', 'lc', 'min_bias',
+                 'trigmask', 'fadc', 'atwd', 'aorb', 'hit_size',
+                 'charge_pos', 'charge_pre', 'charge_max', 'charge_pst')
+
+    # Decoded fields (in hit_dtype) which are passed to from_fields
+    fields = ('utc', 'lc', 'min_bias', 'trigmask', 'fadc', 'atwd', 'aorb',
+              'hit_size', 'charge_pos', 'charge_pre', 'charge_max',
+              'charge_pst')
+
     def __init__(self, omkey, utc, cw1, cw3):
         self.omkey = omkey
+        self.hub_num = int(omkey[0:2])
+        self.dom_num = int(omkey[3:5])
         self.utc = utc
-        self.hdr = [ cw1 & 0xffffffff, cw3 & 0xffffffff]
-
-    def __getattr__(self, name):
-        if name == "hub_num":
-            return int(self.omkey[0:2])
-        elif name == "dom_num":
-            return int(self.omkey[3:5])
-        if name == "lc":
-            return (self.hdr[0] >> 16) & 3
-        elif name == "min_bias":
-            return bool((self.hdr[0] >> 30) & 1)
-        elif name == "fadc":
-            return self.hdr[0] & 0x8000 != 0
-        elif name == "atwd":
-            return self.hdr[0] & 0x4000 != 0
-        elif name == "aorb":
-            return "AB"[(self.hdr[0] >> 11) & 1]
-        elif name == "dig_info":
-            ff = '-'
-            fa = '-'
-            if self.fadc: ff = 'F'
-            if self.atwd: fa = self.aorb
-            return ff+fa
-        elif name == "trigmask":
-            return (self.hdr[0] >> 18) & 0xfff
-        elif name == "hit_size":
-            return self.hdr[0] & 0x7ff
-        elif name == "chargestamp":
-            lsh = 0
-            if self.hdr[1] & 0x80000000: lsh = 1
-            return ((self.hdr[1] >> 27) & 0xf,
-                            ((self.hdr[1] >> 18) & 0x1ff) << lsh,
-                            ((self.hdr[1] >>  9) & 0x1ff) << lsh,
-                            ((self.hdr[1] & 0x1ff) << lsh))
-        elif name == "charge_pos":
-            return self.chargestamp[0]
-        elif name == "charge_pre":
-            return self.chargestamp[1]
-        elif name == "charge_max":
-            return self.chargestamp[2]
-        elif name == "charge_pst":
-            return self.chargestamp[3]
-        else:
-            raise AttributeError, name
+        cw1 &= 0xffffffff
+        cw3 &= 0xffffffff
+        self.lc = (cw1 >> 16) & 3
+        self.min_bias = bool((cw1 >> 30) & 1)
+        self.trigmask = (cw1 >> 18) & 0xfff
+        self.fadc = cw1 & 0x8000 != 0
+        self.atwd = cw1 & 0x4000 != 0
+        self.aorb = "AB"[(cw1 >> 11) & 1]
+        self.hit_size = cw1 & 0x7ff
+        lsh = 0
+        if cw3 & 0x80000000: lsh = 1
+        self.charge_pos = (cw3 >> 27) & 0xf
+        self.charge_pre = ((cw3 >> 18) & 0x1ff) << lsh
+        self.charge_max = ((cw3 >>  9) & 0x1ff) << lsh
+        self.charge_pst = (cw3 & 0x1ff) << lsh
+
+    @classmethod
+    def from_fields(cls, dom, fields):
+        """Returns hit for dom (tuple of omkey, hub_num, dom_num) with the
+        already decoded fields (in the order of Hit.fields)"""
+        hit = cls.__new__(cls)
+        hit.omkey, hit.hub_num, hit.dom_num = dom
+        hit.utc, hit.lc, hit.min_bias, hit.trigmask, hit.fadc, hit.atwd, \
+            aorb, hit.hit_size, hit.charge_pos, hit.charge_pre, \
+            hit.charge_max, hit.charge_pst = fields
+        hit.aorb = "AB"[aorb]
+        return hit
+
+    @property
+    def dig_info(self):
+        ff = '-'
+        fa = '-'
+        if self.fadc: ff = 'F'
+        if self.atwd: fa = self.aorb
+        return ff+fa
+
+    @property
+    def chargestamp(self):
+        return (self.charge_pos, self.charge_pre, self.charge_max,
+                self.charge_pst)
 
     def __str__(self):
         return "HIT: %s %d %x %x %3.3x %s %2d %d %d %d %d" % ( ( \
                 self.omkey, self.utc, self.lc,
                 self.min_bias, self.trigmask, self.dig_info, ) + self.chargestamp + ( self.hit_size, ) )
 
+
+def record_offsets(buf, start=0):
+    """Returns array of the byte offsets of the complete records in buf
+    (starting from start), and the offset just past the last complete record.
+    Record lengths are read through a buffer of buf, which struct reads
+    faster than an array, without copying any of it"""
+    data = buffer(buf, start)
+    unpack_recl = _recl_struct.unpack_from
+    offsets = []
+    append = offsets.append
+    pos = 0
+    end = len(data)
+    last = end-HEADER_SIZE
+    while pos <= last:
+        recl = unpack_recl(data, pos)[0]
+        if recl < HEADER_SIZE:
+            raise ValueError("Bad record length "+str(recl)+" at byte "+
+                             str(start+pos))
+        following = pos+recl
+        if following > end:
+            break
+        append(pos)
+        pos = following
+    return np.array(offsets, dtype=np.int64)+start, start+pos
+
+
+def dom_index(strings, oms):
+    """Returns array of the dense DOM indices of arrays of string and om
+    numbers (N_DOMS for DOMs off the in-ice grid)"""
+    strings = np.asarray(strings, dtype=np.int32)
+    oms = np.asarray(oms, dtype=np.int32)
+    index = (strings-1)*DOMS_PER_STRING+(oms-1)
+    index[(strings<1) | (strings>N_STRINGS) |
+          (oms<1) | (oms>DOMS_PER_STRING)] = N_DOMS
+    return index.astype(np.uint16)
+
+
+def dom_omkeys(indices):
+    """Returns list of the omkeys of dense DOM indices"""
+    return ["%02d-%02d" % (index//DOMS_PER_STRING+1,
+                           index%DOMS_PER_STRING+1)
+            for index in np.asarray(indices).tolist()]
+
+
+def dom_counts(doms):
+    """Returns array of the number of hits of each DOM (by dense index) in
+    array of DOM indices, leaving out DOMs off the grid"""
+    return np.bincount(doms, minlength=N_DOMS+1)[:N_DOMS]
+
+
+def record_headers(buf, offsets):
+    """Returns structured array (raw_dtype) of the headers of the records of
+    buf (uint8 array) starting at offsets"""
+    if len(offsets)==0:
+        return np.zeros(0, dtype=raw_dtype)
+    # Gather the headers through a sliding window view of the buffer, so only
+    # the header bytes are copied
+    windows = as_strided(buf, shape=(len(buf)-HEADER_SIZE+1, HEADER_SIZE),
+                         strides=(buf.strides[0], buf.strides[0]))
+    return windows[offsets].view(raw_dtype)[:,0]
+
+
+def decode_records(buf, offsets, stats=None):
+    """Decodes the records of buf (uint8 array) starting at offsets into a
+    structured array of hits (hit_dtype), using vectorized bit operations.
+    Raises UnknownMBIDError for mbids not in the nickname file. Time spent
+    looking up mbids is added to StreamStats stats, if given"""
+    hits = np.zeros(len(offsets), dtype=hit_dtype)
+    if len(offsets)==0:
+        return hits
+
+    headers = record_headers(buf, offsets)
+    w1 = headers['w1'].astype(np.uint32)
+    w3 = headers['w3'].astype(np.uint32)
+    hits['utc'] = headers['utc']
+    hits['mbid'] = headers['mbid']
+    if stats is not None:
+        started = time.time()
+    locs, hits['string'], hits['om'] = translate(hits['mbid'])
+    if stats is not None:
+        stats.times["lookup"] += time.time()-started
+    hits['dom'] = dom_index(hits['string'], hits['om'])
+    hits['w1'] = w1
+    hits['w3'] = w3
+    hits['lc'] = (w1 >> 16) & 3
+    hits['min_bias'] = (w1 >> 30) & 1
+    hits['trigmask'] = (w1 >> 18) & 0xfff
+    hits['fadc'] = (w1 & 0x8000) != 0
+    hits['atwd'] = (w1 & 0x4000) != 0
+    hits['aorb'] = (w1 >> 11) & 1
+    hits['hit_size'] = w1 & 0x7ff
+    lsh = w3 >> 31
+    hits['charge_pos'] = (w3 >> 27) & 0xf
+    hits['charge_pre'] = ((w3 >> 18) & 0x1ff) << lsh
+    hits['charge_max'] = ((w3 >>  9) & 0x1ff) << lsh
+    hits['charge_pst'] = (w3 & 0x1ff) << lsh
+    return hits
+
+
+def decode_file(filename, processes=1, chunks=None):
+    """Decodes all complete records beginning in a single hitspool file (see
+    file_offsets) into a structured array of hits (hit_dtype). With more
+    than one process (None for the number of cores), the records are split
+    into chunks (defaults to four per process, see record_bounds) which are
+    decoded in parallel and joined in order"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes>1:
+        offsets = file_offsets(filename)
+        if chunks is None:
+            chunks = 4*processes
+        jobs = [(filename, offsets[begin:end]) for begin, end
+                in zip(*record_bounds(len(offsets), chunks))]
+        pool = multiprocessing.Pool(min(processes, max(1, len(jobs))))
+        try:
+            blocks = pool.map(decode_range, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return np.concatenate([np.zeros(0, dtype=hit_dtype)]+blocks)
+
+    start = record_start(filename)
+    if start is None:
+        return np.zeros(0, dtype=hit_dtype)
+    with open(filename, 'rb') as f:
+        buf = np.frombuffer(f.read(), dtype=np.uint8)
+    offsets, end = record_offsets(buf, start)
+    return decode_records(buf, offsets)
+
+
+def scan_records(files, every=4096, chunk_size=1<<22):
+    """Scans the records of hitspool files (read in order, so records may
+    run from one file into the next), returning a record index for each file.
+    An index is a dictionary of the byte offset and utc of the first record
+    beginning in the file ("start", "first_utc"), the utc of the last one
+    ("last_utc"), the number of them ("count"), and arrays of the byte
+    offsets and utcs of every every-th record of the stream ("offsets",
+    "utcs"). Only record headers are read, and nothing is decoded"""
+    sizes = [os.path.getsize(filename) for filename in files]
+    # Stream offset of the beginning of each file
+    bounds = np.cumsum([0]+sizes)
+    indexes = []
+    for size in sizes:
+        indexes.append({"size": size, "start": 0, "first_utc": 0,
+                        "last_utc": 0, "count": 0, "offsets": [],
+                        "utcs": []})
+
+    leftover = np.zeros(0, dtype=np.uint8)
+    base = 0
+    n_records = 0
+    for filename in files:
+        with open(filename, 'rb') as f:
+            chunk = f.read(chunk_size)
+            while len(chunk)>0:
+                buf = np.concatenate((leftover,
+                                      np.frombuffer(chunk, dtype=np.uint8)))
+                offsets, end = record_offsets(buf)
+                utcs = record_headers(buf, offsets)['utc'].astype(np.int64)
+                offsets += base
+                numbers = n_records + np.arange(len(offsets))
+                sampled = numbers % every == 0
+                owners = np.searchsorted(bounds, offsets, side='right')-1
+                for i in np.unique(owners).tolist():
+                    mine = owners==i
+                    index = indexes[i]
+                    if index["count"]==0:
+                        index["start"] = int(offsets[mine][0]-bounds[i])
+                        index["first_utc"] = int(utcs[mine][0])
+                    index["last_utc"] = int(utcs[mine][-1])
+                    index["count"] += int(np.count_nonzero(mine))
+                    index["offsets"].append(offsets[mine & sampled]-bounds[i])
+                    index["utcs"].append(utcs[mine & sampled])
+                n_records += len(offsets)
+                base += end
+                leftover = buf[end:]
+                chunk = f.read(chunk_size)
+
+    for index in indexes:
+        index["offsets"] = np.concatenate(
+            [np.zeros(0, dtype=np.int64)]+index["offsets"])
+        index["utcs"] = np.concatenate(
+            [np.zeros(0, dtype=np.int64)]+index["utcs"])
+    return indexes
+
+
+def index_name(filename):
+    """Returns name of the sidecar record index file of a hitspool file"""
+    return os.path.splitext(filename)[0]+".hsidx.npz"
+
+
+def read_index(filename):
+    """Returns record index of hitspool file from its sidecar file, or None
+    if there is no sidecar matching the current file"""
+    indexfile = index_name(filename)
+    if not os.path.isfile(indexfile):
+        return None
+    try:
+        saved = np.load(indexfile)
+        try:
+            stat = os.stat(filename)
+            if int(saved['size'])!=stat.st_size or \
+            float(saved['mtime'])!=stat.st_mtime:
+                return None
+            index = {"size": stat.st_size}
+            for key in ("start", "first_utc", "last_utc", "count"):
+                index[key] = int(saved[key])
+            index["offsets"] = saved['offsets']
+            index["utcs"] = saved['utcs']
+        finally:
+            saved.close()
+    except Exception:
+        # Unreadable index is just made again
+        return None
+    return index
+
+
+def write_index(filename, index):
+    """Writes record index of hitspool file to its sidecar file. Failing to
+    write it only costs scanning the file again next time"""
+    indexfile = index_name(filename)
+    tempfile = indexfile[:-4]+"-"+str(os.getpid())+".npz"
+    try:
+        np.savez(tempfile, mtime=os.stat(filename).st_mtime, **index)
+        os.rename(tempfile, indexfile)
+    except (IOError, OSError):
+        pass
+
+
+def file_indexes(files, every=4096):
+    """Returns record indexes of hitspool files (in order), from their
+    sidecar files, or by scanning them if any sidecar is missing or stale"""
+    indexes = [read_index(filename) for filename in files]
+    if any(index is None for index in indexes):
+        indexes = scan_records(files, every)
+        for filename, index in zip(files, indexes):
+            write_index(filename, index)
+    return indexes
+
+
+def starts_with_record(filename, n_records=16, window=1<<16):
+    """Returns whether a hitspool file begins with a record, going by the
+    chain of record lengths from its first byte. The chain must hold at
+    least two complete records (or all of the file) of the same type and in
+    time order, up to n_records of them in the first window bytes, which
+    files beginning partway through a record almost never give"""
+    with open(filename, 'rb') as f:
+        head = f.read(window)
+    try:
+        offsets, end = record_offsets(head)
+    except ValueError:
+        return False
+    whole = len(head)<window and end==len(head)
+    if len(offsets)<2 and not(len(offsets)==1 and whole):
+        return False
+    headers = record_headers(np.frombuffer(head, dtype=np.uint8),
+                             offsets[:n_records])
+    return bool(np.all(headers['rtyp']==headers['rtyp'][0]) and
+                np.all(np.diff(headers['utc'])>=0))
+
+
+def record_start(filename):
+    """Returns byte offset of the first record beginning in a hitspool file,
+    or None if no record begins in it. Files beginning with a record (see
+    starts_with_record) give 0 after reading only their head. Otherwise the
+    record lengths are followed from the last file before it in its
+    directory that begins with a record (or the first file), past the
+    record running into it"""
+    if starts_with_record(filename):
+        return 0
+    directory = os.path.dirname(filename) or os.curdir
+    files = spool_files(directory)
+    paths = [os.path.abspath(path) for path in files]
+    if os.path.abspath(filename) not in paths:
+        return 0
+    i = paths.index(os.path.abspath(filename))
+    first = i-1
+    while first>0 and not starts_with_record(files[first]):
+        first -= 1
+    if first<0:
+        return 0
+    index = scan_records(files[first:i+1])[-1]
+    if index["count"]==0:
+        return None
+    return index["start"]
+
+
+def scan_offsets(filename, start=0, chunk_size=1<<22):
+    """Returns array of the byte offsets of the complete records of a
+    hitspool file from start (a record boundary) on, hopping over the record
+    lengths (see record_offsets) of one chunk at a time"""
+    pieces = [np.zeros(0, dtype=np.int64)]
+    base = start
+    leftover = ""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(chunk_size)
+        while len(chunk)>0:
+            buf = leftover+chunk
+            offsets, end = record_offsets(buf)
+            pieces.append(offsets+base)
+            base += end
+            leftover = buf[end:]
+            chunk = f.read(chunk_size)
+    return np.concatenate(pieces)
+
+
+def file_offsets(filename):
+    """Returns array of the byte offsets of all complete records beginning
+    in a hitspool file, from record_start on"""
+    start = record_start(filename)
+    if start is None:
+        return np.zeros(0, dtype=np.int64)
+    return scan_offsets(filename, start)
+
+
+def record_bounds(n_records, n_chunks):
+    """Returns arrays of the beginning and end record numbers of up to
+    n_chunks pieces of n_records records, of about the same size"""
+    if n_records==0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    begins = np.unique(np.linspace(0, n_records, n_chunks,
+                                   endpoint=False).astype(np.int64))
+    ends = np.append(begins[1:], n_records).astype(np.int64)
+    return begins, ends
+
+
+def decode_range(job):
+    """Decodes the records of a hitspool file for job (filename, offsets),
+    reading only the bytes from the first offset to the end of the last
+    record"""
+    filename, offsets = job
+    if len(offsets)==0:
+        return np.zeros(0, dtype=hit_dtype)
+    with open(filename, 'rb') as f:
+        f.seek(offsets[-1])
+        recl = _recl_struct.unpack(f.read(4))[0]
+        f.seek(offsets[0])
+        buf = np.frombuffer(f.read(offsets[-1]+recl-offsets[0]),
+                            dtype=np.uint8)
+    return decode_records(buf, offsets-offsets[0])
+
+
+def head_utc(filename):
+    """Returns utc of the record a hitspool file begins with, or None if it
+    doesn't begin with one (see starts_with_record)"""
+    if not starts_with_record(filename):
+        return None
+    with open(filename, 'rb') as f:
+        head = np.frombuffer(f.read(HEADER_SIZE), dtype=np.uint8)
+    return int(record_headers(head, np.zeros(1, dtype=np.int64))[0]['utc'])
+
+
+def spool_name(directory):
+    """Returns name of the file caching the utc each hitspool file in
+    directory begins with"""
+    return os.path.join(directory, "hsspool.json")
+
+
+def spool_times(directory):
+    """Returns dictionary of the utc each hitspool file in directory begins
+    with (see head_utc) by name. Times are cached in the directory's spool
+    file, and only found again for files whose size or modification time
+    changed"""
+    path = spool_name(directory)
+    cached = {}
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            # Unreadable cache is just made again
+            cached = {}
+
+    times = {}
+    entries = {}
+    changed = False
+    for item in sorted(os.listdir(directory)):
+        if not '.dat' in item:
+            continue
+        stat = os.stat(os.path.join(directory, item))
+        entry = cached.get(item)
+        if entry is None or "head_utc" not in entry or \
+        entry["size"]!=stat.st_size or entry["mtime"]!=stat.st_mtime:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime,
+                     "head_utc": head_utc(os.path.join(directory, item))}
+            changed = True
+        entries[item] = entry
+        times[item] = entry["head_utc"]
+
+    if changed or len(entries)!=len(cached):
+        # Failing to write the cache only costs reading the files again
+        temp_path = path+"."+str(os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            pass
+    return times
+
+
+def spool_files(directory, utc_range=None):
+    """Returns sorted list of the hitspool files in directory. Giving
+    utc_range (start, stop), stop excluded, leaves out the files before the
+    last one beginning with a record before start, and the files from the
+    first one beginning with a record at or after stop, going by the times
+    they begin with (see spool_times). Only the heads of the files are read,
+    and the first file left begins with a record (or is the first file)"""
+    names = sorted(item for item in os.listdir(directory) if '.dat' in item)
+    files = [os.path.join(directory, name) for name in names]
+    if utc_range is None or len(names)==0:
+        return files
+    start, stop = utc_range
+    times = spool_times(directory)
+
+    # Records are time-sorted, so all those before a file beginning with a
+    # record before start are before start too
+    first = 0
+    if start is not None:
+        for i, name in enumerate(names):
+            if times[name] is not None:
+                if times[name]>=start:
+                    break
+                first = i
+    end = len(names)
+    if stop is not None:
+        for i in range(first, len(names)):
+            if times[names[i]] is not None and times[names[i]]>=stop:
+                end = i
+                break
+    return files[first:end]
+
+
+def cache_doms(mbids, doms):
+    """Fills dictionary of DOM tuples (omkey, hub_num, dom_num) by mbid for
+    any new mbids in array mbids"""
+    new_mbids = [mbid for mbid in np.unique(mbids).tolist()
+                 if mbid not in doms]
+    if len(new_mbids)>0:
+        locs, strings, oms = translate(new_mbids)
+        for dom in zip(new_mbids, locs, strings.tolist(), oms.tolist()):
+            doms[dom[0]] = dom[1:]
+    return doms
+
+
+def block_rows(block):
+    """Returns list of (mbid, fields) tuples for the hits in block, where
+    fields are in the order of Hit.fields"""
+    return list(zip(block['mbid'].tolist(),
+                    zip(*[block[name].tolist() for name in Hit.fields])))
+
+
+def hits_from_block(block, doms=None):
+    """Returns list of Hit objects for the hits in a structured array block.
+    Optionally takes dictionary of DOM tuples by mbid, which is filled as
+    needed"""
+    if doms is None:
+        doms = {}
+    cache_doms(block['mbid'], doms)
+    return [Hit.from_fields(doms[mbid], fields)
+            for mbid, fields in block_rows(block)]
+
+
+def h5_rows(block):
+    """Returns structured array of hits table rows (h5_dtype) for the hits
+    in a structured array block"""
+    rows = np.zeros(len(block), dtype=h5_dtype)
+    if len(block)==0:
+        return rows
+    rows['omkey'] = translate(block['mbid'])[0].astype('S8')
+    rows['hub_num'] = block['string']
+    rows['dom_num'] = block['om']
+    for name in ('utc', 'lc', 'min_bias', 'trigmask', 'charge_pos',
+                 'charge_pre', 'charge_max', 'charge_pst', 'hit_size'):
+        rows[name] = block[name]
+    # Same as Hit.dig_info
+    ff = np.where(block['fadc'], 'F', '-')
+    fa = np.where(block['atwd'], np.where(block['aorb'], 'B', 'A'), '-')
+    rows['dig_info'] = np.char.add(ff, fa)
+    # dig_info only shows aorb for atwd hits, so keep it in its own column
+    rows['aorb'] = block['aorb']
+    return rows
+
+
+def compact_hits(block):
+    """Returns structured array of compact hits (compact_dtype) for the hits
+    in a structured array block"""
+    hits = np.zeros(len(block), dtype=compact_dtype)
+    for name in ('utc', 'dom', 'trigmask', 'hit_size', 'charge_pos',
+                 'charge_pre', 'charge_max', 'charge_pst'):
+        hits[name] = block[name]
+    hits['flags'] = (block['lc'] |
+                     block['min_bias'].astype(np.uint8)*FLAG_MIN_BIAS |
+                     block['fadc'].astype(np.uint8)*FLAG_FADC |
+                     block['atwd'].astype(np.uint8)*FLAG_ATWD |
+                     block['aorb']*FLAG_AORB)
+    return hits
+
+
+def hits_from_h5(rows):
+    """Returns list of Hit objects for the hits in a structured array of
+    hits table rows (h5_dtype). Tables written before the aorb column was
+    added only have aorb for atwd hits (through dig_info)"""
+    dig_info = rows['dig_info'].tolist()
+    if 'aorb' in rows.dtype.names:
+        aorb = rows['aorb'].tolist()
+    else:
+        aorb = [int(info[1]=='B') for info in dig_info]
+    fields = zip(rows['utc'].tolist(), rows['lc'].tolist(),
+                 rows['min_bias'].tolist(), rows['trigmask'].tolist(),
+                 [info[0]=='F' for info in dig_info],
+                 [info[1]!='-' for info in dig_info],
+                 aorb, rows['hit_size'].tolist(), rows['charge_pos'].tolist(),
+                 rows['charge_pre'].tolist(), rows['charge_max'].tolist(),
+                 rows['charge_pst'].tolist())
+    doms = zip(rows['omkey'].tolist(), rows['hub_num'].tolist(),
+               rows['dom_num'].tolist())
+    return [Hit.from_fields(dom, hit_fields)
+            for dom, hit_fields in zip(doms, fields)]
+
+
+class HitFilter(object):
+    """Declarative filter on hits. Conditions left as None are not applied.
+    The filter is evaluated as masks on blocks of decoded hits (before any
+    Hit objects are made), and hub conditions are also used to skip whole
+    hub directories. Can also be called on a single Hit object.
+        utc_range: (start, stop) utc of hits kept, stop excluded (either may
+                   be None for no bound)
+        hubs: hub (string) numbers of hits kept
+        doms: DOM numbers (position on string) of hits kept
+        omkeys: omkey strings ("XX-YY") of hits kept
+        lc: local coincidence value(s) of hits kept
+        min_bias: whether kept hits must (True) or must not (False) be
+                  min bias hits
+        trigmask: trigger bits of which kept hits must have at least one
+        min_charge, max_charge: range of charge_max of hits kept (inclusive)
+    """
+    def __init__(self, utc_range=None, hubs=None, doms=None, omkeys=None,
+                 lc=None, min_bias=None, trigmask=None, min_charge=None,
+                 max_charge=None):
+        if utc_range is None:
+            utc_range = (None, None)
+        self.utc_start, self.utc_stop = utc_range
+        self.hubs = self._as_set(hubs)
+        self.doms = self._as_set(doms)
+        self.omkeys = self._as_set(omkeys)
+        self.lc = self._as_set(lc)
+        self.min_bias = min_bias
+        self.trigmask = trigmask
+        self.min_charge = min_charge
+        self.max_charge = max_charge
+
+    @staticmethod
+    def _as_set(values):
+        if values is None:
+            return None
+        if isinstance(values, (int, long, str)):
+            return set([values])
+        return set(values)
+
+    def accepts_hub(self, hub_num):
+        """Returns whether any hits from hub hub_num could pass the filter"""
+        if self.hubs is not None and hub_num not in self.hubs:
+            return False
+        if self.omkeys is not None and \
+        hub_num not in set(int(omkey[0:2]) for omkey in self.omkeys):
+            return False
+        return True
+
+    def accepts_dom(self, omkey, hub_num, dom_num):
+        """Returns whether hits from a DOM could pass the filter"""
+        return (self.accepts_hub(hub_num) and
+                (self.doms is None or dom_num in self.doms) and
+                (self.omkeys is None or omkey in self.omkeys))
+
+    def finished(self, utc):
+        """Returns whether no hits at or after utc can pass the filter"""
+        return self.utc_stop is not None and utc>=self.utc_stop
+
+    def mask(self, block):
+        """Returns boolean array of which hits in block pass the filter"""
+        mask = np.ones(len(block), dtype=bool)
+        if self.utc_start is not None:
+            mask &= block['utc']>=self.utc_start
+        if self.utc_stop is not None:
+            mask &= block['utc']<self.utc_stop
+        if self.lc is not None:
+            mask &= np.in1d(block['lc'], list(self.lc))
+        if self.min_bias is not None:
+            mask &= block['min_bias']==self.min_bias
+        if self.trigmask is not None:
+            mask &= (block['trigmask'] & self.trigmask)!=0
+        if self.min_charge is not None:
+            mask &= block['charge_max']>=self.min_charge
+        if self.max_charge is not None:
+            mask &= block['charge_max']<=self.max_charge
+        if self.hubs is not None:
+            mask &= np.in1d(block['string'], list(self.hubs))
+        if self.doms is not None:
+            mask &= np.in1d(block['om'], list(self.doms))
+        if self.omkeys is not None:
+            keys = [int(omkey[0:2])*100+int(omkey[3:5])
+                    for omkey in self.omkeys]
+            mask &= np.in1d(block['string'].astype(np.int32)*100+block['om'],
+                            keys)
+        return mask
+
+    def __call__(self, hit):
+        """Returns whether a single Hit object passes the filter"""
+        if self.utc_start is not None and hit.utc<self.utc_start:
+            return False
+        if self.utc_stop is not None and hit.utc>=self.utc_stop:
+            return False
+        if self.lc is not None and hit.lc not in self.lc:
+            return False
+        if self.min_bias is not None and hit.min_bias!=self.min_bias:
+            return False
+        if self.trigmask is not None and (hit.trigmask & self.trigmask)==0:
+            return False
+        if self.min_charge is not None and hit.charge_max<self.min_charge:
+            return False
+        if self.max_charge is not None and hit.charge_max>self.max_charge:
+            return False
+        return self.accepts_dom(hit.omkey, hit.hub_num, hit.dom_num)
+
+
+class StreamStats(object):
+    """Counters and per-stage timings of hit streams, for finding what a slow
+    stream is bound by. Streams are instrumented by passing them a
+    StreamStats (streams without one skip all of it), and streams sharing
+    one add to the same counts. Streams run in other threads each need
+    their own part (see part), as stage times are found from differences
+    of the shared times. The stages are reading data ("read", which
+    includes decompressing tarfiles), decoding records ("decode"), looking up
+    mbids ("lookup"), filtering ("filter"), and merging hubs ("merge"). If
+    progress is a number of seconds, a progress line is written to output
+    (defaults to stderr) that often"""
+    stages = ("read", "decode", "lookup", "filter", "merge")
+    counters = ("bytes_read", "records_decoded", "hits_filtered",
+                "hits_merged", "file_switches")
+
+    def __init__(self, progress=None, output=None):
+        self.progress = progress
+        self.output = output
+        self.start = time.time()
+        self.last_progress = self.start
+        self.bytes_read = 0
+        self.records_decoded = 0
+        self.hits_filtered = 0
+        self.hits_merged = 0
+        self.file_switches = 0
+        self.times = dict((stage, 0.) for stage in self.stages)
+        self.parts = []
+
+    def part(self):
+        """Returns new StreamStats for a stream run in another thread, whose
+        counts and times are added to these in snapshot"""
+        part = StreamStats()
+        self.parts.append(part)
+        return part
+
+    def busy(self):
+        """Returns total time of the stages other than merging"""
+        return sum(self.times[stage] for stage in self.stages
+                   if stage!="merge")
+
+    def merge(self, function):
+        """Returns the hit or block of hits from function (the merge step of
+        a HitStream), timing it without the time spent in the other stages"""
+        started = time.time()
+        busy = self.busy()
+        try:
+            result = function()
+        finally:
+            self.times["merge"] += time.time()-started-(self.busy()-busy)
+        if isinstance(result, np.ndarray):
+            self.hits_merged += len(result)
+        else:
+            self.hits_merged += 1
+        self.update()
+        return result
+
+    def snapshot(self):
+        """Returns dictionary of the current counts and stage times (summed
+        over the parts, so stage times of threads running at once can add up
+        to more than the elapsed time)"""
+        elapsed = time.time()-self.start
+        parts = [self]+self.parts
+        snapshot = {"elapsed": elapsed}
+        for name in self.counters:
+            snapshot[name] = sum(getattr(part, name) for part in parts)
+        snapshot["records_per_second"] = (snapshot["records_decoded"]/elapsed
+                                          if elapsed>0 else 0.)
+        for stage in self.stages:
+            snapshot[stage+"_time"] = sum(part.times[stage] for part in parts)
+        return snapshot
+
+    def progressLine(self):
+        snapshot = self.snapshot()
+        return ("hsreader: %.1f s, %d records decoded (%.0f/s), %.1f MB read, "
+                "%d file switches, %d hits filtered out, %d hits merged | " %
+                (snapshot["elapsed"], snapshot["records_decoded"],
+                 snapshot["records_per_second"], snapshot["bytes_read"]/1e6,
+                 snapshot["file_switches"], snapshot["hits_filtered"],
+                 snapshot["hits_merged"]) +
+                ", ".join("%s %.2f s" % (stage, snapshot[stage+"_time"])
+                          for stage in self.stages))
+
+    def update(self):
+        """Writes a progress line if one is due"""
+        if self.progress is None:
+            return
+        now = time.time()
+        if now-self.last_progress>=self.progress:
+            self.last_progress = now
+            print(self.progressLine(), file=self.output or sys.stderr)
+
+
+def _put(queue, stopping, item):
+    """Puts item in queue once there's room, returning False if stopping is
+    set first"""
+    while not stopping.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _read_ahead(paths, start, chunk_size, queue, stopping):
+    """Puts chunks (path, start, data) of files in queue for a ReadAhead.
+    Each file ends with an empty chunk, and the last file with None. Errors
+    are put in the queue instead, to be raised by read"""
+    try:
+        for path in paths:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                while True:
+                    data = np.frombuffer(f.read(chunk_size), dtype=np.uint8)
+                    if not _put(queue, stopping, (path, start, data)):
+                        return
+                    if len(data)==0:
+                        break
+                    start += len(data)
+            start = 0
+    except Exception as e:
+        _put(queue, stopping, e)
+        return
+    _put(queue, stopping, None)
+
+
+class ReadAhead(object):
+    """Reads chunks of files (in order, from byte start of the first) in a
+    background thread, so that reading and opening the next file overlap
+    with decoding. Chunks are handed out by read. At most memory_limit bytes
+    of chunks are held at once: those waiting in the queue, the one the
+    thread is waiting to queue, and the two being read from (unless a single
+    read is longer than a chunk). So chunks are cut to a quarter of
+    memory_limit if chunk_size is larger, though never below min_chunk
+    (limits under four of those are exceeded). The thread stops once the
+    ReadAhead is stopped or dropped"""
+    min_chunk = 1<<12
+
+    def __init__(self, paths, start=0, chunk_size=1<<22, memory_limit=1<<26):
+        self.chunk_size = min(chunk_size, max(self.min_chunk, memory_limit//4))
+        self.queue = Queue.Queue(max(1, memory_limit//self.chunk_size-3))
+        self.stopping = threading.Event()
+
+        # File being handed out, its chunks (start, data) that may still be
+        # read, and whether the end of it has been reached
+        self.path = None
+        self.chunks = []
+        self.at_end = False
+        self.finished = False
+
+        self.thread = threading.Thread(target=_read_ahead,
+                                       args=(list(paths), start,
+                                             self.chunk_size, self.queue,
+                                             self.stopping))
+        self.thread.daemon = True
+        _background.add(self)
+        self.thread.start()
+        _background_workers.add(self.thread)
+
+    def __del__(self):
+        # Dropped without being stopped, so let the thread end on its own
+        self.stopping.set()
+
+    def nextChunk(self):
+        """Moves to the next chunk, returning False if there are none left"""
+        if self.finished:
+            return False
+        item = self.queue.get()
+        if item is None:
+            self.finished = True
+            return False
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+        path, start, data = item
+        if path!=self.path:
+            self.path = path
+            self.chunks = []
+        self.at_end = len(data)==0
+        if not self.at_end:
+            self.chunks.append((start, data))
+        return True
+
+    def read(self, path, start, nbytes):
+        """Returns uint8 array of up to nbytes of file path, beginning at byte
+        start (which can't be before an earlier read). Reads within a chunk
+        aren't copied, and chunks ending before start are dropped"""
+        while self.path!=path:
+            if not self.nextChunk():
+                return np.zeros(0, dtype=np.uint8)
+        # Take chunks from the queue until they hold all of the bytes
+        while not self.at_end and (len(self.chunks)==0 or
+        self.chunks[-1][0]+len(self.chunks[-1][1])<start+nbytes):
+            if not self.nextChunk():
+                break
+        self.chunks = [(begin, data) for begin, data in self.chunks
+                       if begin+len(data)>start]
+        if len(self.chunks)==0:
+            return np.zeros(0, dtype=np.uint8)
+        if start<self.chunks[0][0]:
+            raise ValueError("Can't read back before the read-ahead chunks")
+
+        pieces = []
+        count = 0
+        for begin, data in self.chunks:
+            pieces.append(data[max(start-begin, 0):start-begin+nbytes])
+            count += len(pieces[-1])
+            if count>=nbytes:
+                break
+        if len(pieces)==1:
+            return pieces[0]
+        return np.concatenate(pieces)
+
+    def stop(self):
+        """Stops the thread, dropping any chunks left"""
+        self.stopping.set()
+        self.thread.join()
+        _background.discard(self)
+
+
+# Read-ahead threads and hub workers still running, which are stopped at exit
+# (before the modules they use are torn down). Held weakly, so those dropped
+# are stopped by their owners going away, and only their threads (or
+# processes) still finishing are waited for
+_background = weakref.WeakSet()
+_background_workers = weakref.WeakSet()
+
+@atexit.register
+def _stop_background():
+    for worker in list(_background):
+        worker.stop()
+    for worker in list(_background_workers):
+        worker.join()
+
+
 class HubStream:
-    """Stream of hits from single hitspool file (passing filter)"""
-    # Clean up if possible (especially lookup)
-    def __init__(self, directory, hitfilter=lambda x: True):
-        self.files = []
-        # Grab hitspool data files
-        for item in os.listdir(directory):
-            if '.dat' in item:
-                self.files.append(os.path.join(directory,item))
+    """Stream of hits from single hitspool file (passing filter, which may be
+    a function of a Hit object or a HitFilter). Data is read
+    in chunks with file reads (backend "read") or through read-only memory
+    maps of the files (backend "mmap"), which avoids copying the data.
+    With the read backend, giving readahead (a memory limit in bytes) reads
+    the files in a background thread (see ReadAhead). Giving utc_range
+    (start, stop), stop excluded, keeps only hits in that range, and skips
+    the files at either end without any (see spool_files). Instrumented if
+    given a StreamStats"""
+    backends = ("read", "mmap")
 
-        # Make sure the hitspool files are in order
-        self.files.sort()
+    def __init__(self, directory, hitfilter=None, chunk_size=1<<22,
+                 backend="read", stats=None, readahead=None, utc_range=None):
+        if backend not in self.backends:
+            raise ValueError("Unknown HubStream backend "+str(backend))
+        if readahead is not None and backend!="read":
+            raise ValueError("Read-ahead needs the read backend, not "+
+                             str(backend))
 
-        # Grab first file to start
-        self.f = open(self.files[0])
         self.filter = hitfilter
+        self.chunk_size = chunk_size
+        if readahead is not None:
+            # Read in the same chunks as the read-ahead thread (see ReadAhead)
+            self.chunk_size = min(chunk_size,
+                                  max(ReadAhead.min_chunk, readahead//4))
+        self.backend = backend
+        self.stats = stats
+        self.readahead = readahead
+        self.reader = None
+        self.utc_range = utc_range
+
+        # Buffer of bytes read but not yet decoded, and the offset in the
+        # current file just past the end of the buffer
+        self.buf = np.zeros(0, dtype=np.uint8)
+        self.pos = 0
+        self.offset = 0
+
+        # Record indexes of the files (made when first needed)
+        self.indexes = None
+
+        # Grab first file to start (there may be none in utc_range)
+        self.findFiles(directory)
+        self.f = None
+        self.size = 0
+        if len(self.files)>0:
+            self.openFile()
+
+        # Decoded hits waiting to be made into Hit objects by next
+        self.rows = []
+        self.row_index = 0
+        self.doms = {}
+
+        # Hits left over from seeking to be returned by readBlock
+        self.pending = None
+        self.exhausted = len(self.files)==0
 
     def __iter__(self):
         return self
 
+    def findFiles(self, directory):
+        # Grab hitspool data files in order, and those to read
+        self.paths = spool_files(directory)
+        self.files = spool_files(directory, self.utc_range)
+        self.first_offset = 0
+        if len(self.files)==0 or self.utc_range is None or \
+        self.utc_range[0] is None:
+            return
+        # Start from the last indexed record before utc_range if the record
+        # indexes are already there (they aren't made just for this)
+        indexes = [read_index(path) for path in self.paths]
+        if any(index is None for index in indexes):
+            return
+        self.indexes = indexes
+        found = self.indexedStart(self.utc_range[0])
+        first = self.paths.index(self.files[0])
+        last = self.paths.index(self.files[-1])
+        if found is not None and first<=found[0]<=last:
+            self.files = self.paths[found[0]:last+1]
+            self.first_offset = found[1]
+
+    def openFile(self, start=None):
+        if start is None:
+            start = self.first_offset
+        if self.readahead is not None:
+            # The read-ahead thread opens the files itself
+            if self.reader is None:
+                self.reader = ReadAhead(self.files, start, self.chunk_size,
+                                        self.readahead)
+            self.f = None
+            self.size = os.path.getsize(self.files[0])
+        else:
+            self.f = open(self.files[0], 'rb')
+            self.size = os.fstat(self.f.fileno()).st_size
+        self.offset = start
+
+    def closeFile(self):
+        if self.f is not None:
+            self.f.close()
+
+    def close(self):
+        """Closes the current file, and stops any read-ahead"""
+        self.closeFile()
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+
     def nextFile(self):
-        self.f.close()
+        self.closeFile()
         self.files.pop(0)
         if len(self.files)==0:
             raise StopIteration
-        self.f = open(self.files[0])
+        self.openFile(0)
+        if self.stats is not None:
+            self.stats.file_switches += 1
+
+    def readAt(self, start, nbytes):
+        """Returns uint8 array of up to nbytes of the current file, beginning
+        at byte start"""
+        nbytes = min(nbytes, self.size-start)
+        if nbytes<=0:
+            return np.zeros(0, dtype=np.uint8)
+        if self.reader is not None:
+            return self.reader.read(self.files[0], start, nbytes)
+        if self.backend=="mmap":
+            # Map only a window of the file (which must begin on a page
+            # boundary), so memory use doesn't grow with the file size.
+            # The mapping is released once no views of it remain
+            begin = start - start % mmap.ALLOCATIONGRANULARITY
+            window = mmap.mmap(self.f.fileno(), start+nbytes-begin,
+                               access=mmap.ACCESS_READ, offset=begin)
+            return np.frombuffer(window, dtype=np.uint8)[start-begin:]
+        self.f.seek(start)
+        return np.frombuffer(self.f.read(nbytes), dtype=np.uint8)
+
+    def readChunk(self, start, nbytes):
+        """Same as readAt, counted in stats (if there are any)"""
+        if self.stats is None:
+            return self.readAt(start, nbytes)
+        started = time.time()
+        data = self.readAt(start, nbytes)
+        self.stats.times["read"] += time.time()-started
+        self.stats.bytes_read += len(data)
+        return data
+
+    def recordBytes(self):
+        """Returns number of bytes needed to complete the next record (or its
+        header) from the current position"""
+        if len(self.buf)-self.pos < HEADER_SIZE:
+            return HEADER_SIZE
+        return _recl_struct.unpack_from(self.buf, self.pos)[0]
+
+    def refill(self, nbytes):
+        """Reads more data into the buffer so that at least nbytes are
+        available past the current position. Records spanning two files are
+        joined, which is the only time data is copied between buffers"""
+        leftover = self.buf[self.pos:]
+        if len(leftover) <= self.offset:
+            # Leftover bytes all come from the current file, so read a new
+            # chunk starting from them
+            start = self.offset - len(leftover)
+            self.buf = self.readChunk(start, max(self.chunk_size, nbytes))
+            self.pos = 0
+            self.offset = start + len(self.buf)
+            if len(self.buf) >= nbytes:
+                return
+            leftover = self.buf
+
+        # Record runs past the end of the file, so join it with the beginning
+        # of the next file
+        while len(leftover) < nbytes:
+            if self.offset >= self.size:
+                self.nextFile()
+            piece = self.readChunk(self.offset, nbytes-len(leftover))
+            self.offset += len(piece)
+            leftover = np.concatenate((leftover, piece))
+        self.buf = leftover
+        self.pos = 0
 
     def nextRaw(self):
-        buf = self.f.read(54)
-        if len(buf) != 54:
-            self.nextFile()
-            buf = self.f.read(54)
-        recl, rtyp, mbid, utc, unite, ver, fpq, domclk, w1, w3 = unpack(">iiq8xq3hq2i", buf)
-        buf += self.f.read(recl - 54)
+        """Returns the header fields of the next record, and a view of the
+        record's bytes (not copied)"""
+        if len(self.buf)-self.pos < HEADER_SIZE:
+            self.refill(HEADER_SIZE)
+        recl = self.recordBytes()
+        if len(self.buf)-self.pos < recl:
+            self.refill(recl)
+        recl, rtyp, mbid, utc, unite, ver, fpq, domclk, w1, w3 = \
+            unpack_from(">iiq8xq3hq2i", self.buf, self.pos)
+        buf = self.buf[self.pos:self.pos+recl]
+        self.pos += recl
         return recl, rtyp, mbid, utc, unite, ver, fpq, domclk, w1, w3, buf
 
+    def readBlock(self):
+        """Returns structured array of all hits decoded from the next chunk of
+        data (before filtering)"""
+        if self.pending is not None:
+            block = self.pending
+            self.pending = None
+            return block
+        if self.exhausted:
+            raise StopIteration
+        while True:
+            if self.stats is not None:
+                started = time.time()
+                lookup = self.stats.times["lookup"]
+            offsets, end = record_offsets(self.buf, self.pos)
+            if len(offsets)>0:
+                block = decode_records(self.buf, offsets, self.stats)
+                self.pos = end
+                if self.stats is not None:
+                    self.stats.times["decode"] += time.time()-started-\
+                        (self.stats.times["lookup"]-lookup)
+                    self.stats.records_decoded += len(block)
+                    self.stats.update()
+                return block
+            # No complete record left in the buffer, so read more
+            self.refill(self.recordBytes())
+
+    def maskBlock(self, block):
+        """Returns the hits of block in utc_range and passing a HitFilter (if
+        there are any). Raises StopIteration once no more hits can pass"""
+        if self.utc_range is not None:
+            block = self.rangeBlock(block)
+        if not isinstance(self.filter, HitFilter) or len(block)==0:
+            return block
+        # Hub data is time-sorted, so nothing later can pass either
+        if self.filter.finished(block['utc'][0]):
+            raise StopIteration
+        if self.stats is None:
+            return block[self.filter.mask(block)]
+        started = time.time()
+        passed = block[self.filter.mask(block)]
+        self.stats.times["filter"] += time.time()-started
+        self.stats.hits_filtered += len(block)-len(passed)
+        return passed
+
+    def rangeBlock(self, block):
+        """Returns the hits of block in utc_range. Raises StopIteration once no
+        more hits can be in it"""
+        start, stop = self.utc_range
+        # Hub data is time-sorted, so only the ends of the block are cut
+        if stop is not None and block['utc'][0]>=stop:
+            raise StopIteration
+        first = 0
+        last = len(block)
+        if start is not None:
+            first = np.searchsorted(block['utc'], start, side='left')
+        if stop is not None:
+            last = np.searchsorted(block['utc'], stop, side='left')
+        if self.stats is not None:
+            self.stats.hits_filtered += len(block)-(last-first)
+        return block[first:last]
+
+    def nextBlock(self):
+        """Returns structured array of the hits (passing filter) decoded from
+        the next chunk of data"""
+        while True:
+            block = self.maskBlock(self.readBlock())
+            if self.filter is not None and \
+            not isinstance(self.filter, HitFilter):
+                if self.stats is not None:
+                    started = time.time()
+                    count = len(block)
+                hits = hits_from_block(block, self.doms)
+                block = block[np.array([self.filter(hit) for hit in hits],
+                                       dtype=bool)]
+                if self.stats is not None:
+                    self.stats.times["filter"] += time.time()-started
+                    self.stats.hits_filtered += count-len(block)
+            if len(block)>0:
+                return block
+
     def next(self):
-        # Go through hits until one passes the filter
+        # Go through hits until one passes the filter, only making Hit objects
+        # as they are requested (a HitFilter is already applied to the block)
         while True:
-            recl, rtyp, mbid, utc, unite, ver, fpq, domclk, w1, w3, buf = self.nextRaw()
-            mbid = "%12.12x" % mbid
-            omkey = lookup( mbid )[3]
-            hit = Hit(omkey, utc, w1, w3)
-            if self.filter(hit):
+            while self.row_index>=len(self.rows):
+                block = self.maskBlock(self.readBlock())
+                cache_doms(block['mbid'], self.doms)
+                self.rows = block_rows(block)
+                self.row_index = 0
+            mbid, fields = self.rows[self.row_index]
+            self.row_index += 1
+            hit = Hit.from_fields(self.doms[mbid], fields)
+            if self.filter is None or isinstance(self.filter, HitFilter):
                 return hit
+            if self.stats is None:
+                if self.filter(hit):
+                    return hit
+                continue
+            started = time.time()
+            passed = self.filter(hit)
+            self.stats.times["filter"] += time.time()-started
+            if passed:
+                return hit
+            self.stats.hits_filtered += 1
+
+    def skipTo(self, utc):
+        """Drops hits before utc from the current position of the stream"""
+        # Hits already decoded for next
+        self.rows = [row for row in self.rows[self.row_index:]
+                     if row[1][0]>=utc]
+        self.row_index = 0
+        if len(self.rows)>0:
+            return
+        while True:
+            try:
+                block = self.readBlock()
+            except StopIteration:
+                self.exhausted = True
+                return
+            block = block[np.searchsorted(block['utc'], utc, side='left'):]
+            if len(block)>0:
+                self.pending = block
+                return
+
+    def indexedStart(self, utc):
+        """Returns number of the file and byte offset in it to read from to
+        reach the first hit at or after utc by the record indexes, or None if
+        no file has any records"""
+        found = [i for i in range(len(self.paths))
+                 if self.indexes[i]["count"]>0]
+        if len(found)==0:
+            return None
+        # First file with hits at or after utc (or the last file with any)
+        later = [i for i in found if self.indexes[i]["last_utc"]>=utc]
+        if len(later)>0:
+            i = later[0]
+        else:
+            i = found[-1]
+        index = self.indexes[i]
+        # Last indexed record before utc, so no hit at utc is skipped
+        k = np.searchsorted(index["utcs"], utc, side='left')-1
+        if k>=0:
+            return i, int(index["offsets"][k])
+        return i, index["start"]
+
+    def seek(self, utc):
+        """Moves the stream to the first hit at or after utc (passing filter).
+        The record indexes of the files are used to skip whole files, and to
+        jump to within a few thousand records of utc in a file"""
+        if self.indexes is None:
+            self.indexes = file_indexes(self.paths)
+        found = self.indexedStart(utc)
+        if found is None:
+            self.exhausted = True
+            return
+        i, start = found
+
+        self.close()
+        self.files = self.paths[i:]
+        self.openFile(start)
+        self.buf = np.zeros(0, dtype=np.uint8)
+        self.pos = 0
+        self.rows = []
+        self.row_index = 0
+        self.pending = None
+        self.exhausted = False
+        self.skipTo(utc)
+
+
+class TarHubStream(HubStream):
+    """Stream of hits from a hub's hitspool tarfile (passing filter), read
+    straight out of the nested .tar.gz and .tar.bz2 archives as they are
+    decompressed, without extracting anything to disk. Since the archives
+    can only be read forward, by default the .dat files must be in order in
+    the archive. Otherwise (ordered=False), the archive is read through once
+    first to find the order, and files reached early are held in memory
+    until their turn"""
+    backends = ("tar",)
+
+    def __init__(self, tarball, hitfilter=None, chunk_size=1<<22,
+                 ordered=True, stats=None, utc_range=None):
+        self.ordered = ordered
+        HubStream.__init__(self, tarball, hitfilter, chunk_size, backend="tar",
+                           stats=stats, utc_range=utc_range)
+
+    @staticmethod
+    def openArchive(tarball):
+        """Returns streams of the gzip tarfile and of the bzip tarfile in it"""
+        outer = tarfile.open(tarball, 'r|gz')
+        member = outer.next()
+        while member is not None and not('.tar.bz2' in member.name):
+            member = outer.next()
+        if member is None:
+            raise ValueError("No bzip tar file found in "+tarball)
+        inner = tarfile.open(fileobj=outer.extractfile(member), mode='r|bz2')
+        return outer, inner
+
+    def nextDatMember(self):
+        """Returns the next hitspool file member of the bzip tarfile, or None
+        if there are none left"""
+        member = self.inner.next()
+        while member is not None and \
+        not(member.isfile() and '.dat' in member.name):
+            member = self.inner.next()
+        return member
+
+    def findFiles(self, tarball):
+        self.names = None
+        if not self.ordered:
+            self.outer, self.inner = self.openArchive(tarball)
+            self.names = []
+            member = self.nextDatMember()
+            while member is not None:
+                self.names.append(member.name)
+                member = self.nextDatMember()
+            self.names.sort()
+            self.inner.close()
+            self.outer.close()
+
+        self.outer, self.inner = self.openArchive(tarball)
+        self.held = {}
+        self.files = []
+        if not self.nextMember():
+            raise ValueError("No hitspool files found in "+tarball)
+
+    def nextMember(self):
+        """Moves to the next hitspool file in the bzip tarfile, returning False
+        if there are none left"""
+        if self.names is None:
+            member = self.nextDatMember()
+            if member is None:
+                return False
+            name = os.path.basename(member.name)
+            if len(self.files)>0 and name<os.path.basename(self.files[-1]):
+                raise ValueError("Hitspool file "+member.name+" is out of "+
+                                 "order in tarfile, so it can't be streamed "+
+                                 "(try ordered=False)")
+            self.member = member
+            self.files.append(member.name)
+            return True
+
+        if len(self.names)==0:
+            return False
+        name = self.names.pop(0)
+        self.files.append(name)
+        # Hold on to any files reached before their turn
+        while name not in self.held:
+            member = self.nextDatMember()
+            if member.name==name:
+                self.member = member
+                return True
+            self.held[member.name] = self.inner.extractfile(member).read()
+        self.member = None
+        self.data = self.held.pop(name)
+        return True
+
+    def openFile(self):
+        if self.member is not None:
+            self.f = self.inner.extractfile(self.member)
+            self.size = self.member.size
+        else:
+            self.f = io.BytesIO(self.data)
+            self.size = len(self.data)
+            self.data = None
+        self.offset = 0
+        # Last chunk read from the archive, which is the only data that can
+        # be read again
+        self.last = np.zeros(0, dtype=np.uint8)
+        self.last_start = 0
+        self.read_pos = 0
+
+    def nextFile(self):
+        self.f.close()
+        if not self.nextMember():
+            self.inner.close()
+            self.outer.close()
+            raise StopIteration
+        self.files.pop(0)
+        self.openFile()
+        if self.stats is not None:
+            self.stats.file_switches += 1
+
+    def readAt(self, start, nbytes):
+        """Returns uint8 array of up to nbytes of the current file, beginning
+        at byte start (which can't be before the last chunk read)"""
+        nbytes = min(nbytes, self.size-start)
+        if nbytes<=0:
+            return np.zeros(0, dtype=np.uint8)
+        if start<self.last_start:
+            raise ValueError("Can't read backwards in a tarfile stream")
+        prefix = self.last[start-self.last_start:self.read_pos-self.last_start]
+        data = np.frombuffer(self.f.read(nbytes-len(prefix)), dtype=np.uint8)
+        self.read_pos += len(data)
+        if len(prefix)>0:
+            data = np.concatenate((prefix, data))
+        self.last = data
+        self.last_start = start
+        return data
+
+    def seek(self, utc):
+        """Skips forward to the first hit at or after utc (passing filter).
+        Since the tarfile can only be read forward, hits already passed can't
+        be sought back to"""
+        self.skipTo(utc)
+
+
+def _hub_worker(args, utc, queue, stopping):
+    """Puts the blocks of hits of hub_stream(*args) (from utc, if given) in
+    queue, followed by None. An error is put in the queue instead"""
+    stream = None
+    try:
+        stream = hub_stream(*args)
+        if utc is not None:
+            stream.seek(utc)
+        while True:
+            try:
+                block = stream.nextBlock()
+            except StopIteration:
+                break
+            if not _put(queue, stopping, block):
+                return
+    except Exception as e:
+        _put(queue, stopping, e)
+        return
+    finally:
+        if stream is not None:
+            stream.close()
+    _put(queue, stopping, None)
+
+
+class HubWorker(object):
+    """Stream of the hits of hub_stream(*args), decoded ahead by a worker
+    thread (mode "thread") or process (mode "process") which passes blocks
+    of hits through a queue of up to max_blocks blocks. Threads overlap
+    as far as reading and numpy release the GIL, while processes decode
+    fully in parallel but copy each block through a pipe. A StreamStats in
+    args should be a part of its own (see StreamStats.part). The worker is
+    stopped once the HubWorker is closed or dropped. Can stand in for a
+    HubStream in a HitStream"""
+    modes = ("thread", "process")
+
+    def __init__(self, args, mode="thread", max_blocks=4):
+        if mode not in self.modes:
+            raise ValueError("Unknown HubWorker mode "+str(mode))
+        self.args = args
+        self.mode = mode
+        self.max_blocks = max_blocks
+        self.start()
+
+    def __iter__(self):
+        return self
+
+    def start(self, utc=None):
+        # Decoded hits waiting to be made into Hit objects by next
+        self.rows = []
+        self.row_index = 0
+        self.doms = {}
+        self.finished = False
+        if self.mode=="thread":
+            self.queue = Queue.Queue(self.max_blocks)
+            self.stopping = threading.Event()
+            self.worker = threading.Thread(target=_hub_worker,
+                                           args=(self.args, utc, self.queue,
+                                                 self.stopping))
+        else:
+            self.queue = multiprocessing.Queue(self.max_blocks)
+            self.stopping = multiprocessing.Event()
+            self.worker = multiprocessing.Process(target=_hub_worker,
+                                                  args=(self.args, utc,
+                                                        self.queue,
+                                                        self.stopping))
+        self.worker.daemon = True
+        _background.add(self)
+        self.worker.start()
+        _background_workers.add(self.worker)
+
+    def stop(self):
+        """Stops the worker, dropping any blocks left"""
+        self.stopping.set()
+        if self.mode=="process":
+            # The process can't finish until what it put in the queue is read
+            while self.worker.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+        self.worker.join()
+        _background.discard(self)
+
+    def close(self):
+        self.stop()
+
+    def __del__(self):
+        # Dropped without being closed, so stop the worker without waiting
+        self.stopping.set()
+        if self.mode=="process":
+            self.worker.terminate()
+
+    def nextBlock(self):
+        """Returns structured array of the hits (passing filter) decoded from
+        the next chunk of data"""
+        if self.finished:
+            raise StopIteration
+        item = self.queue.get()
+        if item is None or isinstance(item, Exception):
+            self.finished = True
+            self.stop()
+            if item is None:
+                raise StopIteration
+            raise item
+        return item
+
+    def next(self):
+        while self.row_index>=len(self.rows):
+            block = self.nextBlock()
+            cache_doms(block['mbid'], self.doms)
+            self.rows = block_rows(block)
+            self.row_index = 0
+        mbid, fields = self.rows[self.row_index]
+        self.row_index += 1
+        return Hit.from_fields(self.doms[mbid], fields)
+
+    def seek(self, utc):
+        """Restarts the worker from the first hit at or after utc"""
+        self.stop()
+        self.start(utc)
+
 
 class HitStream:
-    """Time-sorted stream of hits from HubStreams passed"""
-    def __init__(self, *streams):
+    """Time-sorted stream of hits from HubStreams passed. If a block_size is
+    given, the stream instead gives time-sorted structured arrays of
+    block_size hits (fewer for the last block). Merging is instrumented if
+    given a StreamStats (as stats), which should be shared with the
+    HubStreams so the merge is timed without their stages"""
+    def __init__(self, *streams, **kwargs):
+        self.block_size = kwargs.pop('block_size', None)
+        self.stats = kwargs.pop('stats', None)
+        if len(kwargs)>0:
+            raise TypeError("Unexpected keyword arguments "+str(kwargs.keys()))
+
         self.streams = []
         for stream in streams:
             self.streams.append(stream)
+        self.bufferStreams()
+
+    def bufferStreams(self):
+        """Buffers hits from the current position of each stream"""
+        if self.block_size is not None:
+            # Buffer of sorted hits from each stream not yet merged (None
+            # once the stream is finished), and merged hits not yet returned
+            self.buffers = [np.zeros(0, dtype=hit_dtype)
+                            for stream in self.streams]
+            self.finished = [False for stream in self.streams]
+            self.merged = []
+            self.merged_count = 0
+            return
 
-        # Buffer the first hit from each stream, and track its time
-        self.tophits = []
-        self.times = np.zeros(len(self.streams),'d')
+        # Buffer the first hit from each stream in a heap ordered by time.
+        # The stream index breaks ties, so hits with equal times come out in
+        # the order their streams were passed
+        self.heap = []
         for i in range(len(self.streams)):
-            self.tophits.append(self.streams[i].next())
-            self.times[i] = self.tophits[i].utc
+            try:
+                hit = self.streams[i].next()
+            except StopIteration:
+                continue
+            self.heap.append((hit.utc, i, hit))
+        heapq.heapify(self.heap)
 
     def __iter__(self):
         return self
 
+    def seek(self, utc):
+        """Moves all streams to their first hit at or after utc"""
+        for stream in self.streams:
+            stream.seek(utc)
+        self.bufferStreams()
+
+    def mergeWindow(self):
+        """Merges all buffered hits earlier than the last buffered hit of
+        every unfinished stream, returning False if there are no hits left"""
+        if len(self.streams)==0:
+            return False
+
+        # Make sure every unfinished stream has buffered hits
+        for i in range(len(self.streams)):
+            if not(self.finished[i]) and len(self.buffers[i])==0:
+                try:
+                    self.buffers[i] = self.streams[i].nextBlock()
+                except StopIteration:
+                    self.finished[i] = True
+
+        # Every hit earlier than the cut is known to be in the buffers
+        live_ends = [self.buffers[i]['utc'][-1]
+                     for i in range(len(self.streams)) if not self.finished[i]]
+        if len(live_ends)==0:
+            cut = None
+        else:
+            cut = min(live_ends)
+
+        pieces = []
+        for i in range(len(self.streams)):
+            if cut is None:
+                n = len(self.buffers[i])
+            else:
+                n = np.searchsorted(self.buffers[i]['utc'], cut, side='left')
+            if n>0:
+                pieces.append(self.buffers[i][:n])
+            self.buffers[i] = self.buffers[i][n:]
+
+            # Streams left with only hits at the cut need more hits buffered
+            # before the cut can move on
+            if not(self.finished[i]) and len(self.buffers[i])>0 and \
+            self.buffers[i]['utc'][-1]==cut:
+                try:
+                    self.buffers[i] = np.concatenate(
+                        (self.buffers[i], self.streams[i].nextBlock()))
+                except StopIteration:
+                    self.finished[i] = True
+
+        # Stable sort keeps hits with equal times in stream order
+        if len(pieces)>0:
+            window = np.concatenate(pieces)
+            order = np.argsort(window['utc'], kind='mergesort')
+            self.merged.append(window[order])
+            self.merged_count += len(window)
+        return cut is not None or len(pieces)>0
+
+    def nextBlock(self):
+        """Returns structured array of the next block_size hits in time
+        order"""
+        if self.stats is not None:
+            return self.stats.merge(self.mergeBlock)
+        return self.mergeBlock()
+
+    def mergeBlock(self):
+        while self.merged_count<self.block_size:
+            if not self.mergeWindow():
+                break
+        if self.merged_count==0:
+            raise StopIteration
+        merged = np.concatenate(self.merged)
+        block = merged[:self.block_size]
+        self.merged = [merged[self.block_size:]]
+        self.merged_count = len(self.merged[0])
+        return block
+
     def next(self):
+        if self.block_size is not None:
+            return self.nextBlock()
+        if self.stats is not None:
+            return self.stats.merge(self.nextHit)
+        return self.nextHit()
+
+    def close(self):
+        """Closes all of the streams, stopping any reading ahead"""
+        for stream in self.streams:
+            stream.close()
+
+    def nextHit(self):
         # Grab hit with lowest time, return it, and buffer next hit from that
         # stream
-        if len(self.times)==0:
+        if len(self.heap)==0:
             raise StopIteration
-        earliest_index = np.argmin(self.times)
-        earliest_hit = self.tophits[earliest_index]
+        utc, i, earliest_hit = self.heap[0]
         try:
-            self.tophits[earliest_index] = self.streams[earliest_index].next()
-            self.times[earliest_index] = self.tophits[earliest_index].utc
+            hit = self.streams[i].next()
         except StopIteration:
-            self.times = np.delete(self.times,earliest_index)
-            self.tophits.pop(earliest_index)
-            self.streams.pop(earliest_index)
+            heapq.heappop(self.heap)
+        else:
+            heapq.heapreplace(self.heap, (hit.utc, i, hit))
         return earliest_hit
 
 
+class H5HitStream:
+    """Time-sorted stream of hits from the hits table of an hdf5 file written
+    by write_h5, optionally only those in a utc window (start, stop), stop
+    excluded, and/or from a set of omkeys. The rows of a utc window are found
+    by binary search over the sorted utc column, and the rows of a set of
+    omkeys through the omkey index, so only matching rows are read. Gives Hit
+    objects, so it can be merged by a HitStream, or structured arrays of
+    rows (h5_dtype) from nextBlock"""
+    def __init__(self, filename, utc_range=None, omkeys=None,
+                 chunk_size=1<<16):
+        # Avoid this import in the main file since it is only really necessary here
+        import tables
+
+        self.h5file = tables.open_file(filename, mode="r")
+        self.table = self.h5file.root.hits
+        self.chunk_size = chunk_size
+        if omkeys is None:
+            self.omkeys = None
+        else:
+            if isinstance(omkeys, str):
+                omkeys = [omkeys]
+            self.omkeys = np.array(sorted(set(omkeys)), dtype='S8')
+
+        # Rows to read are start to stop, or the coordinates from start to
+        # stop when only a set of omkeys is asked for
+        self.coords = None
+        if utc_range is None:
+            utc_range = (None, None)
+        if utc_range==(None, None) and self.omkeys is not None:
+            self.coords = self.omkeyRows()
+            self.start, self.stop = 0, len(self.coords)
+        else:
+            self.start = self.findRow(utc_range[0], 0)
+            self.stop = self.findRow(utc_range[1], self.table.nrows)
+
+        # Rows waiting to be made into Hit objects by next
+        self.hits = []
+        self.hit_index = 0
+
+    def __iter__(self):
+        return self
+
+    def findRow(self, utc, default):
+        """Returns the first row with time at or after utc (or default if utc
+        is None), by binary search over the utc column"""
+        if utc is None:
+            return default
+        utcs = self.table.cols.utc
+        low, high = 0, self.table.nrows
+        while low<high:
+            middle = (low+high)//2
+            if utcs[middle]<utc:
+                low = middle+1
+            else:
+                high = middle
+        return low
+
+    def omkeyRows(self):
+        """Returns sorted array of the rows with omkeys in the set"""
+        coords = [self.table.get_where_list('omkey==key', {'key': omkey})
+                  for omkey in self.omkeys]
+        return np.sort(np.concatenate(coords).astype(np.int64))
+
+    def nextBlock(self):
+        """Returns structured array of the next chunk of matching rows"""
+        while self.start<self.stop:
+            stop = min(self.start+self.chunk_size, self.stop)
+            if self.coords is None:
+                rows = self.table.read(self.start, stop)
+                if self.omkeys is not None:
+                    rows = rows[np.in1d(rows['omkey'], self.omkeys)]
+            else:
+                rows = self.table.read_coordinates(self.coords[self.start:stop])
+            self.start = stop
+            if len(rows)>0:
+                return rows
+        self.close()
+        raise StopIteration
+
+    def read(self):
+        """Returns structured array of all remaining matching rows"""
+        blocks = [np.zeros(0, dtype=self.table.dtype)]
+        while True:
+            try:
+                blocks.append(self.nextBlock())
+            except StopIteration:
+                break
+        return np.concatenate(blocks)
+
+    def next(self):
+        if self.hit_index>=len(self.hits):
+            self.hits = hits_from_h5(self.nextBlock())
+            self.hit_index = 0
+        hit = self.hits[self.hit_index]
+        self.hit_index += 1
+        return hit
+
+    def close(self):
+        self.h5file.close()
+
+
+class EventHistograms(object):
+    """Histograms of the hits following each of a sorted list of event times,
+    filled in a single pass over time-sorted blocks of hits (structured
+    arrays, as from a HitStream with a block_size). Each event's histogram
+    covers window (in utc units) after the event with bins of bin_width, and
+    leaves out the DOMs hit more than once in the first dead_window after the
+    event (32 microseconds by default). Events whose windows are still open
+    wait in a ring buffer in time order, so each hit is only compared to the
+    events it could belong to. More events can be added between blocks (as
+    they are found), as long as they come after the hits already added.
+    After all blocks are added (and finish is called) the results are:
+        histograms: array of the histogram of each event
+        stacked: sum of the histograms of all events
+        dead_masks: array of the masks (by dense DOM index) of the DOMs left
+                    out of each event
+        dead_doms: list of the sets of omkeys left out of each event (built
+                   from dead_masks each time it is read)
+    """
+    def __init__(self, event_times, window, bin_width, dead_window=320000):
+        self.window = window
+        self.bin_width = bin_width
+        self.dead_window = dead_window
+        self.n_bins = int(-(-window//bin_width))
+        self.event_times = np.zeros(0, dtype=np.int64)
+        self.histograms = np.zeros((0, self.n_bins), dtype=np.int64)
+        self.dead_masks = np.zeros((0, N_DOMS), dtype=bool)
+
+        # Events with windows still open, the next event not yet reached, and
+        # the time of the last hit added
+        self.pending = collections.deque()
+        self.next_event = 0
+        self.last_utc = None
+        self.addEvents(event_times)
+
+    def addEvents(self, event_times):
+        """Adds sorted event times, which must come after the events and the
+        hits already added"""
+        event_times = np.asarray(event_times, dtype=np.int64)
+        if len(event_times)==0:
+            return
+        times = np.concatenate((self.event_times, event_times))
+        if np.any(np.diff(times)<0):
+            raise ValueError("Event times must be sorted")
+        if self.last_utc is not None and event_times[0]<=self.last_utc:
+            raise ValueError("Events must come after the hits already added")
+        self.event_times = times
+        self.histograms = np.concatenate(
+            (self.histograms,
+             np.zeros((len(event_times), self.n_bins), dtype=np.int64)))
+        self.dead_masks = np.concatenate(
+            (self.dead_masks,
+             np.zeros((len(event_times), N_DOMS), dtype=bool)))
+
+    def done(self):
+        """Returns whether the windows of all events are closed"""
+        return self.next_event>=len(self.event_times) and len(self.pending)==0
+
+    def addBlock(self, block):
+        """Adds the hits of a structured array block, which must come after
+        the hits of all blocks added before"""
+        if len(block)==0:
+            return
+        utcs = block['utc']
+        last = utcs[-1]
+        self.last_utc = last
+
+        # Start events reached by this block
+        while self.next_event<len(self.event_times) and \
+        self.event_times[self.next_event]<=last:
+            self.pending.append({"index": self.next_event,
+                                 "time": self.event_times[self.next_event],
+                                 "dead": None, "doms": [], "bins": []})
+            self.next_event += 1
+        if len(self.pending)==0:
+            return
+
+        doms = block['dom']
+        for event in self.pending:
+            time = event["time"]
+            start = np.searchsorted(utcs, time, side='left')
+            stop = np.searchsorted(utcs, time+self.window, side='left')
+            if event["dead"] is None:
+                # Hold on to hits in the dead window until it closes, when
+                # the DOMs hit more than once are known
+                middle = np.searchsorted(utcs, time+self.dead_window,
+                                         side='left')
+                middle = min(max(middle, start), stop)
+                event["doms"].append(doms[start:middle])
+                event["bins"].append((utcs[start:middle]-time)//self.bin_width)
+                if last<time+self.dead_window:
+                    continue
+                self.closeDeadWindow(event)
+                start = middle
+            self.fill(event, doms[start:stop],
+                      (utcs[start:stop]-time)//self.bin_width)
+
+        # Events are in time order with equal windows, so closed windows are
+        # always at the front
+        while len(self.pending)>0 and \
+        self.pending[0]["time"]+self.window<=last:
+            self.closeEvent(self.pending.popleft())
+
+    def closeDeadWindow(self, event):
+        """Finds the dead DOMs of an event, and fills its histogram with the
+        hits held from its dead window"""
+        doms = np.concatenate([np.zeros(0, dtype=np.uint16)]+event["doms"])
+        bins = np.concatenate([np.zeros(0, dtype=np.int64)]+event["bins"])
+        dead = dom_counts(doms)>1
+        self.dead_masks[event["index"]] = dead
+        # Extra entry for DOMs off the grid, which are never left out
+        event["dead"] = np.append(dead, False)
+        event["doms"] = event["bins"] = None
+        self.fill(event, doms, bins)
+
+    def fill(self, event, doms, bins):
+        bins = bins[~event["dead"][doms]]
+        if len(bins)>0:
+            self.histograms[event["index"]] += np.bincount(
+                bins, minlength=self.n_bins)[:self.n_bins]
+
+    def closeEvent(self, event):
+        if event["dead"] is None:
+            self.closeDeadWindow(event)
+
+    def finish(self):
+        """Closes the windows of all events once there are no more hits"""
+        while self.next_event<len(self.event_times):
+            self.pending.append({"index": self.next_event,
+                                 "time": self.event_times[self.next_event],
+                                 "dead": None, "doms": [], "bins": []})
+            self.next_event += 1
+        while len(self.pending)>0:
+            self.closeEvent(self.pending.popleft())
+
+    @property
+    def stacked(self):
+        return self.histograms.sum(axis=0)
+
+    @property
+    def dead_doms(self):
+        return [set(dom_omkeys(np.flatnonzero(mask)))
+                for mask in self.dead_masks]
+
+
+def event_histograms(hitstream, event_times, window, bin_width,
+                     dead_window=320000):
+    """Returns EventHistograms of the hits following each of a sorted list of
+    event times, from one pass over a stream of time-sorted blocks of hits
+    (a HitStream with a block_size). Seekable streams are moved to the first
+    event, and reading stops once the last event's window is closed. The
+    stream is closed at the end (if it can be)"""
+    histograms = EventHistograms(event_times, window, bin_width, dead_window)
+    try:
+        if len(histograms.event_times)>0 and hasattr(hitstream, 'seek'):
+            hitstream.seek(histograms.event_times[0])
+        for block in hitstream:
+            histograms.addBlock(block)
+            if histograms.done():
+                break
+    finally:
+        if hasattr(hitstream, 'close'):
+            hitstream.close()
+    histograms.finish()
+    return histograms
+
+
+class PulseDetector(object):
+    """Streaming detector of pulses of hits (events) in time-sorted blocks of
+    hits (structured arrays, as from a HitStream with a block_size). Hits are
+    counted in bins of bin_width (starting from the first hit), and as each
+    bin closes it is a candidate event if it has at least fraction of the
+    hits of the fullest bin so far, or (with sigma instead) if it is more
+    than sigma standard deviations above the mean of the previous
+    baseline_bins bins. Candidates from the running maximum which fall below
+    fraction of the final maximum are dropped by events"""
+    def __init__(self, bin_width, fraction=None, sigma=None,
+                 baseline_bins=1000):
+        if (fraction is None)==(sigma is None):
+            raise ValueError("PulseDetector needs one of fraction or sigma")
+        self.bin_width = bin_width
+        self.fraction = fraction
+        self.sigma = sigma
+        self.baseline_bins = baseline_bins
+
+        # Start time of the first bin, the open bin and its count so far, and
+        # counts of the last closed bins for the baseline
+        self.t0 = None
+        self.current = 0
+        self.current_count = 0
+        self.history = np.zeros(0, dtype=np.float64)
+
+        # Summary of the closed bins, and the candidates found in them
+        self.n_bins = 0
+        self.total = 0
+        self.maximum = 0
+        self.candidate_times = []
+        self.candidate_counts = []
+
+    def openTime(self):
+        """Returns start time of the open bin, before which every candidate
+        has been found"""
+        if self.t0 is None:
+            return None
+        return self.t0+self.current*self.bin_width
+
+    def addBlock(self, block):
+        """Adds the hits of a structured array block (which must come after
+        the hits of all blocks added before), returning array of the times of
+        candidate events in the bins it closed"""
+        if len(block)==0:
+            return np.zeros(0, dtype=np.int64)
+        utcs = block['utc']
+        if self.t0 is None:
+            self.t0 = int(utcs[0])
+        bins = (utcs-self.t0)//self.bin_width
+        counts = np.bincount(bins-self.current)
+        counts[0] += self.current_count
+        first = self.current
+        self.current = int(bins[-1])
+        self.current_count = int(counts[-1])
+        return self.closeBins(first, counts[:-1])
+
+    def finish(self):
+        """Closes the open bin once there are no more hits, returning array of
+        its time if it is a candidate event"""
+        if self.t0 is None:
+            return np.zeros(0, dtype=np.int64)
+        times = self.closeBins(self.current, np.array([self.current_count]))
+        self.current += 1
+        self.current_count = 0
+        return times
+
+    def closeBins(self, first, counts):
+        """Checks closed bins (counts, starting from bin first) for candidates,
+        returning array of their times"""
+        if len(counts)==0:
+            return np.zeros(0, dtype=np.int64)
+        if self.fraction is not None:
+            maxima = np.maximum.accumulate(np.maximum(counts, self.maximum))
+            passing = counts>=self.fraction*maxima
+        else:
+            # Mean and standard deviation of the previous baseline_bins bins
+            # of each bin, from running sums
+            series = np.concatenate((self.history, counts))
+            sums = np.concatenate(([0], np.cumsum(series)))
+            squares = np.concatenate(([0], np.cumsum(series**2)))
+            ends = len(self.history)+np.arange(len(counts))
+            starts = np.maximum(ends-self.baseline_bins, 0)
+            n = ends-starts
+            full = n>=self.baseline_bins
+            n = np.maximum(n, 1)
+            mean = (sums[ends]-sums[starts])/n
+            variance = np.maximum((squares[ends]-squares[starts])/n-mean**2, 0)
+            passing = full & (counts>mean+self.sigma*np.sqrt(variance))
+            self.history = series[-self.baseline_bins:]
+        passing &= counts>0
+
+        self.n_bins += len(counts)
+        self.total += int(counts.sum())
+        self.maximum = max(self.maximum, int(counts.max()))
+        indices = np.flatnonzero(passing)
+        times = self.t0+(first+indices)*self.bin_width
+        self.candidate_times.extend(times.tolist())
+        self.candidate_counts.extend(counts[indices].tolist())
+        return times.astype(np.int64)
+
+    def mean(self):
+        """Returns mean number of hits in the closed bins"""
+        if self.n_bins==0:
+            return 0
+        return self.total/self.n_bins
+
+    def events(self):
+        """Returns arrays of the times and hit counts of the bins of the
+        events found"""
+        times = np.array(self.candidate_times, dtype=np.int64)
+        counts = np.array(self.candidate_counts, dtype=np.int64)
+        if self.fraction is not None:
+            keep = counts>=self.fraction*self.maximum
+            times = times[keep]
+            counts = counts[keep]
+        return times, counts
+
+
+def find_events(hitstream, detector, histograms=None):
+    """Runs a PulseDetector over a stream of time-sorted blocks of hits (a
+    HitStream with a block_size), returning the times and hit counts of the
+    bins of the events found. If EventHistograms are given, they are filled
+    for every candidate event in the same pass, holding back blocks until
+    every event that could start in them has been found. The stream is
+    closed at the end (if it can be)"""
+    waiting = collections.deque()
+    try:
+        for block in hitstream:
+            times = detector.addBlock(block)
+            if histograms is None:
+                continue
+            histograms.addEvents(times)
+            waiting.append(block)
+            while len(waiting)>0 and \
+            waiting[0]['utc'][-1]<detector.openTime():
+                histograms.addBlock(waiting.popleft())
+    finally:
+        if hasattr(hitstream, 'close'):
+            hitstream.close()
+    times = detector.finish()
+    if histograms is not None:
+        histograms.addEvents(times)
+        while len(waiting)>0:
+            histograms.addBlock(waiting.popleft())
+        histograms.finish()
+    return detector.events()
+
+
+class HitHistogram(object):
+    """Histogram of hit times over a time grid of n_bins bins of bin_width
+    starting at t0, along with the number of hits on the grid from each DOM
+    (by dense index). Histograms over the same grid (from different hubs,
+    processes, or machines) are partial results which can be added together,
+    and saved to and loaded from disk"""
+    def __init__(self, t0, bin_width, n_bins):
+        self.t0 = int(t0)
+        self.bin_width = int(bin_width)
+        self.n_bins = int(n_bins)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.dom_counts = np.zeros(N_DOMS, dtype=np.int64)
+
+    @property
+    def grid(self):
+        return (self.t0, self.bin_width, self.n_bins)
+
+    @property
+    def end(self):
+        """Time just past the end of the grid"""
+        return self.t0+self.n_bins*self.bin_width
+
+    def addBlock(self, block):
+        """Adds the hits of a time-sorted structured array block, leaving out
+        hits off the grid"""
+        utcs = block['utc']
+        start = np.searchsorted(utcs, self.t0, side='left')
+        stop = np.searchsorted(utcs, self.end, side='left')
+        if stop>start:
+            self.counts += np.bincount(
+                (utcs[start:stop]-self.t0)//self.bin_width,
+                minlength=self.n_bins)
+            self.dom_counts += dom_counts(block['dom'][start:stop])
+
+    def __iadd__(self, other):
+        if other.grid!=self.grid:
+            raise ValueError("Can't add histograms over different time grids")
+        self.counts += other.counts
+        self.dom_counts += other.dom_counts
+        return self
+
+    def __add__(self, other):
+        total = HitHistogram(*self.grid)
+        total += self
+        total += other
+        return total
+
+    def save(self, filename):
+        """Writes the histogram to a .npz file"""
+        np.savez(filename, t0=self.t0, bin_width=self.bin_width,
+                 n_bins=self.n_bins, counts=self.counts,
+                 dom_counts=self.dom_counts)
+
+    @classmethod
+    def load(cls, filename):
+        """Returns histogram read from a .npz file written by save"""
+        saved = np.load(filename)
+        try:
+            histogram = cls(int(saved['t0']), int(saved['bin_width']),
+                            int(saved['n_bins']))
+            histogram.counts = saved['counts']
+            histogram.dom_counts = saved['dom_counts']
+        finally:
+            saved.close()
+        return histogram
+
+
 # def single_load(filename, hitfilter=lambda x: True):
 #     """Loads hit objects from single hitspool file (passing filter) into python
 #     array"""
@@ -170,213 +2256,579 @@ def list_paths(directory):
     return output
 
 
-def unzip_files(source, keyword="", destination="./hsreader_data",
-                force_clear=False):
-    """Unzips hitspool files (that include an optional keyword) into destination
-    directory (usually clears destination directory first, so beware!)"""
-    # Check if the data in destination matches the data that would come from
-    # source (if so, then finish here)
-    if not(force_clear):
-        data_matches = True
-        if os.path.isdir(destination):
-            match_count = 0
-            for src_item in os.listdir(source):
-                src_name_i = src_item.find('.')
-                src_name = src_item[:src_name_i]
-                for dest_item in os.listdir(destination):
-                    dest_name_i = dest_item.find('.')
-                    dest_name = dest_item[:dest_name_i]
-                    if dest_name in src_name:
-                        match_count += 1
-                        break
-            if match_count/len(os.listdir(source))<.8:
-                data_matches = False
-        else:
-            data_matches = False
-        if data_matches:
-            print("Existing data suspected to match source data.\n"+
-                  "Skipping unzip process and using existing data in "+
-                  destination)
-            return list_paths(destination)
-
-    # Clear and get rid of existing destination
-    if os.path.isdir(destination):
-        for item in os.listdir(destination):
-            item_path = os.path.join(destination,item)
-            if item[0]==".":
-                continue
-            if os.path.isdir(item_path):
-                for subitem in os.listdir(item_path):
-                    if subitem[0]==".":
-                        continue
-                    os.remove(os.path.join(item_path,subitem))
-                os.rmdir(item_path)
-            else:
-                os.remove(item_path)
-        os.rmdir(destination)
+def hub_number(path):
+    """Returns hub number from the ichubXX name of a hitspool path, or None if
+    it has no such name"""
+    match = re.search('ichub([0-9]{2})', os.path.basename(path))
+    if match is None:
+        return None
+    return int(match.group(1))
 
-    # Create destination
-    os.mkdir(destination)
 
-    # Get all tar files from the passed directory that have hub data
+def hub_tarfiles(source, keyword=""):
+    """Returns sorted list of hub tar files (that include an optional keyword)
+    in source directory"""
     tarfiles = []
     for item in os.listdir(source):
         if ('ichub' in item) and ('.tar.gz' in item) and (keyword in item):
             tarfiles.append(item)
+    tarfiles.sort()
+    return tarfiles
+
+
+def file_md5(filename):
+    """Returns md5 hex digest of the contents of a file"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        chunk = f.read(1<<22)
+        while len(chunk)>0:
+            md5.update(chunk)
+            chunk = f.read(1<<22)
+    return md5.hexdigest()
+
+
+def read_manifest(destination):
+    """Returns manifest of the unzipped hub cache in destination directory.
+    The manifest has the size, modification time, and md5 hash of each
+    source tar file by path ("sources"), and the hitspool directory and
+    files unzipped from each tar file by md5 hash ("tarfiles")"""
+    path = os.path.join(destination, "manifest.json")
+    if not os.path.isfile(path):
+        return {"sources": {}, "tarfiles": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(destination, manifest):
+    """Writes manifest of the unzipped hub cache in destination directory"""
+    path = os.path.join(destination, "manifest.json")
+    temp_path = path+"."+str(os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def cached_directory(destination, manifest, digest):
+    """Returns hitspool directory unzipped from the tar file with md5 digest,
+    or None if it isn't in the cache or any of its files have changed"""
+    entry = manifest["tarfiles"].get(digest)
+    if entry is None:
+        return None
+    for name, size in entry["files"]:
+        path = os.path.join(destination, name)
+        if not os.path.isfile(path) or os.path.getsize(path)!=size:
+            return None
+    return os.path.join(destination, str(entry["directory"]))
+
+
+def cached_directories(source, keyword="", destination="./hsreader_data"):
+    """Returns hitspool directories already unzipped into destination from
+    the hub tar files in source (that include an optional keyword), without
+    checking the tar files for changes. Tar files moved or deleted from
+    source since they were unzipped are found by their path in the manifest,
+    and tar files the manifest doesn't know at that path by their name. Hubs
+    not found in the cache are reported and left out. Destinations without a
+    manifest are assumed to only hold hitspool directories"""
+    manifest = read_manifest(destination)
+    if len(manifest["sources"])==0:
+        return list_paths(destination)
+
+    source = os.path.abspath(source)
+    gzfiles = set()
+    if os.path.isdir(source):
+        gzfiles.update(hub_tarfiles(source, keyword))
+    for path in manifest["sources"]:
+        if os.path.dirname(path)==source:
+            gzfiles.add(os.path.basename(path))
+    if len(gzfiles)==0:
+        # Source never unzipped here, so go by the names of all cached hubs
+        gzfiles.update(entry["name"] for entry
+                       in manifest["tarfiles"].values())
+    gzfiles = [gzfile for gzfile in gzfiles if ('ichub' in gzfile) and
+               ('.tar.gz' in gzfile) and (keyword in gzfile)]
+
+    directories = []
+    missing = []
+    for gzfile in sorted(gzfiles):
+        known = manifest["sources"].get(os.path.join(source,gzfile))
+        if known is not None and known["md5"] in manifest["tarfiles"]:
+            digests = [known["md5"]]
+        else:
+            digests = [digest for digest, entry
+                       in manifest["tarfiles"].items()
+                       if entry["name"]==gzfile]
+        if len(digests)!=1:
+            missing.append(gzfile)
+            continue
+        directories.append(os.path.join(destination,
+            str(manifest["tarfiles"][digests[0]]["directory"])))
 
-    # Throw error if no tar files found, or output directory is not a directory
+    if len(missing)>0:
+        print("Not reusing", len(missing), "hub file(s) missing from (or "
+              "ambiguous in)", destination+":", ", ".join(missing),
+              file=sys.stderr)
+    return directories
+
+
+def unzip_files(source, keyword="", destination="./hsreader_data",
+                force_clear=False, processes=None):
+    """Unzips hitspool files (that include an optional keyword) into destination
+    directory, which acts as a cache of unzipped hubs. A manifest records each
+    tar file's size, modification time, and md5 hash along with the files
+    unzipped from it, so only new or changed hubs are unzipped (or all of
+    them if force_clear). Each tar file gets its own directory named by its
+    hash, so different spools can share a destination. Hubs are unzipped in
+    parallel by up to processes processes (defaults to the number of cores),
+    and how each hub went is reported at the end. Returns list of the
+    hitspool directories"""
+    # Get all tar files from the passed directory that have hub data
+    tarfiles = hub_tarfiles(source, keyword)
+
+    # Throw error if no tar files found
     if len(tarfiles)==0:
         print("No hitspool tar files found.", file=sys.stderr)
         sys.exit(2)
-    else:
-        print("Unzipping files to",destination)
 
-    # Make sure the tar files are in order
-    tarfiles.sort()
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    manifest = read_manifest(destination)
 
-    # Loop over hub files
+    # Find which tar files already have their data in destination (only
+    # hashing tar files whose size or modification time changed)
+    directories = {}
+    digests = {}
+    jobs = []
     for gzfile in tarfiles:
-        # Get index of current hub
-        i = gzfile.find('ichub')
-        hubindex = gzfile[i+5:i+7]
-        hubstring = 'ichub'+str(hubindex).zfill(2)
-
-        # Unzip gzfile
-        os.system("tar -xzf "+os.path.join(source,gzfile)+" -C "+destination)
-
-        # Grab bzfile
-        bzfiles = []
-        for item in os.listdir(destination):
-            if (hubstring in item) and ('.tar.bz2' in item):
-                bzfiles.append(item)
-
-        # Throw error if not exactly one bzip file found,
-        # but continue to next loop
-        if len(bzfiles)!=1:
-            print(len(bzfiles)," bzip tar files found from hub ",hubindex,
-                ". Expected one bzip tar file.", sep="",file=sys.stderr)
-            print(bzfiles, file=sys.stderr)
-            print("  Error. Skipping hub "+hubindex)
+        path = os.path.abspath(os.path.join(source,gzfile))
+        stat = os.stat(path)
+        known = manifest["sources"].get(path)
+        if known is not None and known["size"]==stat.st_size and \
+        known["mtime"]==stat.st_mtime:
+            digest = known["md5"]
+        else:
+            digest = file_md5(path)
+        manifest["sources"][path] = {"size": stat.st_size,
+                                     "mtime": stat.st_mtime, "md5": digest}
+        digests[gzfile] = digest
+
+        directory = None
+        if not(force_clear):
+            directory = cached_directory(destination, manifest, digest)
+        if directory is not None:
+            directories[gzfile] = directory
             continue
 
-        # Unzip bzfile
-        os.system("tar -xjf "+os.path.join(destination,bzfiles[0])+\
-                  " -C "+destination)
-
-        # Delete the leftover xml file(s)
-        xmlfiles = []
-        for item in os.listdir(destination):
-            if (hubstring in item) and ('.meta.xml' in item):
-                xmlfiles.append(item)
-        for xmlfile in xmlfiles:
-            os.remove(os.path.join(destination,xmlfile))
-
-        # Delete the bzip file
-        os.remove(os.path.join(destination,bzfiles[0]))
-
-        # Grab hitspool directory
-        hsdirectories = []
-        for item in os.listdir(destination):
-            if (hubstring in item) and \
-            os.path.isdir(os.path.join(destination,item)):
-                hsdirectories.append(item)
-
-        # Throw error if not exactly one hitspool directory found,
-        # but continue to next loop
-        if len(hsdirectories)!=1:
-            print(len(hsdirectories)," hitspool directories found from hub ",hubindex,
-                ". Expected one hitspool directory.", sep="",file=sys.stderr)
-            print(hsdirectories, file=sys.stderr)
-            print("  Error. Skipping hub "+hubindex)
+        # Unzip into a fresh directory for this tar file
+        manifest["tarfiles"].pop(digest, None)
+        hubdir = os.path.join(destination, digest[:16])
+        if os.path.isdir(hubdir):
+            shutil.rmtree(hubdir)
+        os.mkdir(hubdir)
+        jobs.append((source, gzfile, hubdir))
+
+    # Remove data of tar files that no source refers to anymore
+    current = set(known["md5"] for known in manifest["sources"].values())
+    for digest in list(manifest["tarfiles"].keys()):
+        if digest not in current:
+            shutil.rmtree(os.path.join(destination, digest[:16]),
+                          ignore_errors=True)
+            del manifest["tarfiles"][digest]
+
+    if len(jobs)==0:
+        write_manifest(destination, manifest)
+        print("All hubs already unzipped in "+destination)
+        return [directories[gzfile] for gzfile in tarfiles]
+    print("Unzipping", len(jobs), "of", len(tarfiles), "hub files to",
+          destination)
+
+    # Unzip each hub in its own process
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    if processes==1:
+        results = [unzip_hub(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(unzip_hub, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Record the unzipped files of each hub in the manifest
+    for job, result in zip(jobs, results):
+        source, gzfile, hubdir = job
+        if result[1] is not None:
             continue
+        hsdirectory = [item for item in os.listdir(hubdir)
+                       if os.path.isdir(os.path.join(hubdir,item))][0]
+        hspath = os.path.join(hubdir, hsdirectory)
+        files = [[os.path.relpath(os.path.join(hspath,item), destination),
+                  os.path.getsize(os.path.join(hspath,item))]
+                 for item in sorted(os.listdir(hspath))]
+        manifest["tarfiles"][digests[gzfile]] = {
+            "name": gzfile,
+            "directory": os.path.relpath(hspath, destination),
+            "files": files}
+        directories[gzfile] = hspath
+    write_manifest(destination, manifest)
 
-    return list_paths(destination)
+    # Report how each hub went
+    failures = [result for result in results if result[1] is not None]
+    print("Unzipped", len(results)-len(failures), "of", len(results), "hubs")
+    for hubindex, error in results:
+        if error is None:
+            print("  Hub "+hubindex+": unzipped")
+        else:
+            print("  Hub "+hubindex+": failed ("+error+")")
 
+    return [directories[gzfile] for gzfile in tarfiles
+            if gzfile in directories]
 
 
-def load_stream(source_dir, keyword="", hitfilter=lambda x: True,
-                data_dir="./hsreader_data", reuse_data=None):
-    """Loads hit objects from hitspool files from all hub tarfiles in
-    directory (time-sorted, passing filter) as a stream"""
-    if reuse_data==True:
-        data_directories = list_paths(data_dir)
+def unzip_hub(job):
+    """Unzips a single hub tar file into destination, cleaning up its
+    leftover files. Takes tuple of (source, gzfile, destination), and returns
+    tuple of the hub index and an error message (None if successful)"""
+    source, gzfile, destination = job
+
+    # Get index of current hub
+    i = gzfile.find('ichub')
+    hubindex = gzfile[i+5:i+7]
+    hubstring = 'ichub'+str(hubindex).zfill(2)
+
+    # Unzip gzfile
+    if subprocess.call(["tar", "-xzf", os.path.join(source,gzfile),
+                        "-C", destination])!=0:
+        return hubindex, "tar failed on "+gzfile
+
+    # Grab bzfile
+    bzfiles = []
+    for item in os.listdir(destination):
+        if (hubstring in item) and ('.tar.bz2' in item):
+            bzfiles.append(item)
+
+    # Delete the leftover xml file(s)
+    xmlfiles = []
+    for item in os.listdir(destination):
+        if (hubstring in item) and ('.meta.xml' in item):
+            xmlfiles.append(item)
+    for xmlfile in xmlfiles:
+        os.remove(os.path.join(destination,xmlfile))
+
+    # Fail if not exactly one bzip file found
+    if len(bzfiles)!=1:
+        for bzfile in bzfiles:
+            os.remove(os.path.join(destination,bzfile))
+        return hubindex, (str(len(bzfiles))+" bzip tar files found, "+
+                          "expected one")
+
+    # Unzip bzfile, then delete it
+    status = subprocess.call(["tar", "-xjf",
+                              os.path.join(destination,bzfiles[0]),
+                              "-C", destination])
+    os.remove(os.path.join(destination,bzfiles[0]))
+    if status!=0:
+        return hubindex, "tar failed on "+bzfiles[0]
+
+    # Grab hitspool directory
+    hsdirectories = []
+    for item in os.listdir(destination):
+        if (hubstring in item) and \
+        os.path.isdir(os.path.join(destination,item)):
+            hsdirectories.append(item)
+
+    # Fail if not exactly one hitspool directory found
+    if len(hsdirectories)!=1:
+        return hubindex, (str(len(hsdirectories))+" hitspool directories "+
+                          "found, expected one")
+
+    return hubindex, None
+
+
+def hub_directories(source_dir, keyword="", hitfilter=None,
+                    data_dir="./hsreader_data", reuse_data=None,
+                    backend="read"):
+    """Returns list of the hitspool directories (or with backend "tar", the
+    hub tarfiles) of all hub tarfiles in directory, unzipping them to
+    data_dir as needed. Hubs a HitFilter would reject entirely are left out"""
+    if backend=="tar":
+        data_directories = [os.path.join(source_dir,item) for item
+                            in hub_tarfiles(source_dir,keyword)]
+    elif reuse_data==True:
+        data_directories = cached_directories(source_dir,keyword,data_dir)
     elif reuse_data==False:
         data_directories = \
             unzip_files(source_dir,keyword,data_dir,force_clear=True)
     else:
         data_directories = unzip_files(source_dir,keyword,data_dir)
 
+    hubdirs = []
+    for hubdir in data_directories:
+        # Skip hubs a HitFilter would reject entirely, without opening them
+        hub_num = hub_number(hubdir)
+        if isinstance(hitfilter, HitFilter) and hub_num is not None and \
+        not hitfilter.accepts_hub(hub_num):
+            continue
+        hubdirs.append(hubdir)
+    return hubdirs
+
+
+def hub_stream(hubdir, hitfilter=None, backend="read", stats=None,
+               readahead=None, utc_range=None):
+    """Returns stream of hits from a hitspool directory (or with backend
+    "tar", a hub tarfile)"""
+    if backend=="tar":
+        if readahead is not None:
+            raise ValueError("Read-ahead needs the read backend, not tar")
+        return TarHubStream(hubdir,hitfilter,stats=stats,utc_range=utc_range)
+    return HubStream(hubdir,hitfilter,backend=backend,stats=stats,
+                     readahead=readahead,utc_range=utc_range)
+
+
+def load_stream(source_dir, keyword="", hitfilter=None,
+                data_dir="./hsreader_data", reuse_data=None, backend="read",
+                block_size=None, stats=None, readahead=None, workers=None,
+                max_blocks=4, utc_range=None):
+    """Loads hit objects from hitspool files from all hub tarfiles in
+    directory (time-sorted, passing filter) as a stream. The filter may be a
+    function of a Hit object or a HitFilter, which is applied to decoded
+    blocks before hit objects are made. The backend ("read" or "mmap") sets
+    how HubStreams get data from the hitspool files, or with backend "tar"
+    hits are streamed straight out of the hub tarfiles without unzipping them
+    to data_dir. If a block_size is given, the stream gives time-sorted
+    structured arrays of hits instead of hit objects. If a StreamStats is
+    given, all of the streams are instrumented with it. Giving readahead (a
+    memory limit in bytes for each hub) reads the hitspool files in
+    background threads. With workers "thread" or "process", each hub is
+    decoded by a HubWorker, up to max_blocks blocks ahead of the merge (the
+    hits come out in the same order). Each worker thread keeps its own part
+    of the stats, and stats aren't kept in worker processes.
+    Giving utc_range (start, stop), stop excluded, keeps only hits in that
+    range, and skips the hitspool files at either end of each hub and the
+    hubs without any, by the times their files begin with (see
+    spool_files).
+    Files in hub tarfiles aren't skipped"""
     streams = []
 
-    for hubdir in data_directories:
-        # Form stream from hitspool directory
-        streams.append(HubStream(hubdir,hitfilter))
+    for hubdir in hub_directories(source_dir,keyword,hitfilter,data_dir,
+                                  reuse_data,backend):
+        if utc_range is not None and backend!="tar" and \
+        len(spool_files(hubdir,utc_range))==0:
+            continue
+        if workers is None:
+            streams.append(hub_stream(hubdir,hitfilter,backend,stats,
+                                      readahead,utc_range))
+        elif workers=="process":
+            streams.append(HubWorker((hubdir,hitfilter,backend,None,
+                                      readahead,utc_range),workers,
+                                     max_blocks))
+        else:
+            part = None if stats is None else stats.part()
+            streams.append(HubWorker((hubdir,hitfilter,backend,part,
+                                      readahead,utc_range),workers,
+                                     max_blocks))
 
-    stream = HitStream(*streams)
+    stream = HitStream(*streams, block_size=block_size, stats=stats)
 
     return stream
 
 
-def load(source_dir, keyword="", hitfilter=lambda x: True,
-         data_dir="./hsreader_data", reuse_data=None):
+def load(source_dir, keyword="", hitfilter=None,
+         data_dir="./hsreader_data", reuse_data=None, backend="read",
+         form="hits", block_size=1<<16):
     """Loads hit objects from hitspool files from all hub tarfiles in
-    directory (time-sorted, passing filter) to a python array"""
-    hitstream = load_stream(source_dir,keyword,hitfilter,data_dir)
-    hits = []
-    for hit in hitstream:
-        hits.append(hit)
-    return hits
+    directory (time-sorted, passing filter) to a python array. With form
+    "array" the hits are instead loaded to a single structured array of
+    compact hits (compact_dtype, 22 bytes per hit), or with form "columns"
+    to a dictionary of an array for each field of compact_dtype. The arrays
+    are filled with blocks of block_size hits, doubling in size as needed"""
+    if form=="hits":
+        hitstream = load_stream(source_dir,keyword,hitfilter,data_dir,
+                                reuse_data,backend)
+        hits = []
+        for hit in hitstream:
+            hits.append(hit)
+        return hits
+    if form not in ("array", "columns"):
+        raise ValueError("Unknown load form "+str(form))
+
+    hitstream = load_stream(source_dir,keyword,hitfilter,data_dir,reuse_data,
+                            backend,block_size)
+    if form=="array":
+        arrays = {None: np.zeros(block_size, dtype=compact_dtype)}
+    else:
+        arrays = dict((name, np.zeros(block_size, dtype=compact_dtype[name]))
+                      for name in compact_dtype.names)
+    size = block_size
+    n = 0
+    for block in hitstream:
+        hits = compact_hits(block)
+        if n+len(hits)>size:
+            # Arrays are resized in place, so only one copy of them exists
+            size = max(2*size, n+len(hits))
+            for array in arrays.values():
+                array.resize(size, refcheck=False)
+        for name, array in arrays.items():
+            if name is None:
+                array[n:n+len(hits)] = hits
+            else:
+                array[n:n+len(hits)] = hits[name]
+        n += len(hits)
+    for array in arrays.values():
+        array.resize(n, refcheck=False)
+
+    if form=="array":
+        return arrays[None]
+    return arrays
 
 
-def write_h5(source_dir, outfilename, keyword="", hitfilter=lambda x: True,
-             data_dir="./hsreader_data", reuse_data=None):
+def write_h5(source_dir, outfilename, keyword="", hitfilter=None,
+             data_dir="./hsreader_data", reuse_data=None, backend="read",
+             complevel=5, complib="blosc", block_size=1<<16):
     """Writes hits from hitspool files from all hub tarfiles in
-    directory (time-sorted, passing filter) to hdf5 file"""
+    directory (time-sorted, passing filter) to hdf5 file. Hits are appended
+    in blocks of block_size to a chunked table compressed with complib
+    (falling back to zlib if it isn't available) at level complevel, and the
+    utc and omkey columns are indexed"""
     # Avoid this import in the main file since it is only really necessary here
     import tables
 
-    # Prepare for hdf5 files
-    class HitData(tables.IsDescription):
-        omkey = tables.StringCol(8,pos=0)     # 8-character string
-        hub_num = tables.Int8Col(pos=1)       # Signed 8-bit integer
-        dom_num = tables.Int8Col(pos=2)       # Signed 8-bit integer
-        utc = tables.Int64Col(pos=3)          # Signed 64-bit integer
-        lc = tables.Int8Col(pos=4)            # Signed 8-bit integer
-        min_bias = tables.BoolCol(pos=5)      # Boolean value
-        trigmask = tables.StringCol(16,pos=6) # 16-character string
-        dig_info = tables.StringCol(8,pos=7)  # 8-character string
-        charge_pos = tables.Int16Col(pos=8)   # Signed 16-bit integer
-        charge_pre = tables.Int16Col(pos=9)   # Signed 16-bit integer
-        charge_max = tables.Int16Col(pos=10)  # Signed 16-bit integer
-        charge_pst = tables.Int16Col(pos=11)  # Signed 16-bit integer
-        hit_size = tables.Int8Col(pos=12)     # Signed 8-bit integer
+    if outfilename[-3:]!=".h5" and outfilename[-5:]!=".hdf5":
+        outfilename += ".h5"
+
+    if complevel>0 and tables.which_lib_version(complib) is None:
+        complib = "zlib"
+    filters = tables.Filters(complevel=complevel, complib=complib,
+                             shuffle=True)
 
+    h5file = tables.open_file(outfilename, mode="w", title="HitSpool Hits")
+    try:
+        hittable = h5file.create_table("/", "hits", h5_dtype, "All Hits",
+                                       filters=filters,
+                                       expectedrows=10000000)
 
+        hitstream = load_stream(source_dir,keyword,hitfilter,data_dir,
+                                reuse_data,backend,block_size)
+        while True:
+            try:
+                block = hitstream.nextBlock()
+            except StopIteration:
+                break
+            hittable.append(h5_rows(block))
+        hittable.flush()
 
+        # Index after writing, so the indexes are built once over all rows.
+        # The utc column is already sorted, so its index is completely sorted
+        hittable.cols.utc.create_csindex(filters=filters)
+        hittable.cols.omkey.create_index(filters=filters)
+    finally:
+        h5file.close()
+
+
+def read_h5(filename, utc_range=None, omkeys=None):
+    """Returns structured array of the hits (h5_dtype) from hdf5 file written
+    by write_h5, optionally only those in a utc window (start, stop), stop
+    excluded, and/or from a set of omkeys"""
+    return H5HitStream(filename, utc_range, omkeys).read()
 
-    if outfilename[-3:]!=".h5" and outfilename[-5:]!=".hdf5":
-        outfilename += ".h5"
 
-    h5file = tables.openFile(outfilename, mode="w", title="HitSpool Hits")
-    hittable = h5file.createTable("/", "hits", HitData, "All Hits")
-
-    hitstream = load_stream(source_dir,keyword,hitfilter,data_dir)
-    for hit in hitstream:
-        # Form a row in the table for each hit
-        hittable.row['omkey'] = hit.omkey
-        hittable.row['hub_num'] = hit.hub_num
-        hittable.row['dom_num'] = hit.dom_num
-        hittable.row['utc'] = hit.utc
-        hittable.row['lc'] = hit.lc
-        hittable.row['min_bias'] = hit.min_bias
-        hittable.row['trigmask'] = hit.trigmask
-        hittable.row['dig_info'] = hit.dig_info
-        hittable.row['charge_pos'] = hit.charge_pos
-        hittable.row['charge_pre'] = hit.charge_pre
-        hittable.row['charge_max'] = hit.charge_max
-        hittable.row['charge_pst'] = hit.charge_pst
-        hittable.row['hit_size'] = hit.hit_size
-        hittable.row.append()
-
-    hittable.flush()
-    h5file.close()
+def first_utc(hubdirs, backend="read"):
+    """Returns the earliest time of the first hits of hitspool directories
+    (or hub tarfiles), reading only their first records"""
+    utcs = []
+    for hubdir in hubdirs:
+        try:
+            utcs.append(hub_stream(hubdir,backend=backend).nextRaw()[3])
+        except StopIteration:
+            continue
+    if len(utcs)==0:
+        return None
+    return min(utcs)
+
+
+def histogram_hub(job):
+    """Returns HitHistogram of the hits of a single hub (passing filter).
+    Takes tuple of (hubdir, grid, hitfilter, backend, filename), where grid
+    is a tuple of (t0, bin_width, n_bins), and the histogram is also saved
+    to filename unless it is None"""
+    hubdir, grid, hitfilter, backend, filename = job
+    histogram = HitHistogram(*grid)
+    stream = hub_stream(hubdir,hitfilter,backend)
+    while True:
+        try:
+            block = stream.nextBlock()
+        except StopIteration:
+            break
+        histogram.addBlock(block)
+        # Hub data is time-sorted, so the rest is off the grid
+        if block['utc'][-1]>=histogram.end:
+            break
+    if filename is not None:
+        histogram.save(filename)
+    return histogram
+
+
+def histogram_hubs(source_dir, bin_width, n_bins, t0=None, keyword="",
+                   hitfilter=None, data_dir="./hsreader_data",
+                   reuse_data=None, backend="read", processes=None,
+                   partial_dir=None):
+    """Returns HitHistogram of hits from hitspool files from all hub tarfiles
+    in directory (passing filter, which must be a HitFilter or another
+    function that can be pickled), over a grid of n_bins bins of bin_width
+    starting at t0 (defaults to the time of the first hit). Since
+    histogramming doesn't need the hubs in time order, each hub is
+    histogrammed separately by up to processes processes (defaults to the
+    number of cores), and the partial histograms are added. If partial_dir
+    is given, each hub's partial histogram is also saved there, so they can
+    be added later with merge_histograms (as when hubs are split over
+    several machines)"""
+    hubdirs = hub_directories(source_dir,keyword,hitfilter,data_dir,
+                              reuse_data,backend)
+    if t0 is None:
+        t0 = first_utc(hubdirs,backend)
+        if t0 is None:
+            t0 = 0
+    grid = (t0, bin_width, n_bins)
+
+    if partial_dir is not None and not os.path.isdir(partial_dir):
+        os.makedirs(partial_dir)
+    jobs = []
+    for i, hubdir in enumerate(hubdirs):
+        filename = None
+        if partial_dir is not None:
+            hub_num = hub_number(hubdir)
+            if hub_num is None:
+                hub_num = i
+            filename = os.path.join(partial_dir, "ichub%02d.npz" % hub_num)
+        jobs.append((hubdir, grid, hitfilter, backend, filename))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    if processes==1:
+        partials = [histogram_hub(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            partials = pool.map(histogram_hub, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    histogram = HitHistogram(*grid)
+    for partial in partials:
+        histogram += partial
+    return histogram
+
+
+def merge_histograms(filenames):
+    """Returns sum of the HitHistograms saved in files"""
+    histogram = None
+    for filename in filenames:
+        partial = HitHistogram.load(filename)
+        if histogram is None:
+            histogram = partial
+        else:
+            histogram += partial
+    return histogram
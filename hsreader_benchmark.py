@@ -0,0 +1,296 @@
+#! /usr/bin/env python
+#
+# hsreader_benchmark.py
+# Script for timing the hot paths of hsreader on synthetic hits
+#
+#
+# Ben Hokanson-Fasig
+# Created   10/17/26
+# Last edit 10/17/26
+#
+
+
+from __future__ import division, print_function
+import argparse
+
+parser_desc = """Script for timing the hot paths of hsreader on synthetic
+                 hits. A synthetic spool is generated to time decoding,
+                 merging, filtering, loading, and hdf5 export (reporting
+                 hits per second and peak memory of each), then merging
+                 algorithms are compared on synthetic hit objects"""
+parser_ep = """Note that this script depends on the standard python libraries
+               os, shutil, tempfile, time, random, resource,
+               multiprocessing, numpy; and the custom libraries hsreader,
+               hsgenerator, daq_nicknames (and pytables for hdf5 export)"""
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(description=parser_desc, epilog=parser_ep)
+parser.add_argument('-n', '--hubs', default=86, type=int,
+                    help="""number of hub streams to merge (default is 86)""")
+parser.add_argument('--hits', default=20000, type=int,
+                    help="""number of hits in each hub stream (default is
+                    20000)""")
+parser.add_argument('-r', '--repeat', default=3, type=int,
+                    help="""number of times to repeat each timing, keeping
+                    the best (default is 3)""")
+parser.add_argument('--spool-hubs', default=8, type=int,
+                    help="""number of hubs in the synthetic spool (default is
+                    8)""")
+parser.add_argument('--rate', default=500., type=float,
+                    help="""hit rate of each DOM in the synthetic spool in Hz
+                    (default is 500)""")
+parser.add_argument('-t', '--time', default=1., type=float,
+                    help="""length of the synthetic spool in seconds (default
+                    is 1s)""")
+parser.add_argument('-d', '--datadir',
+                    help="""directory in which to write the synthetic spool.
+                    If not given, a temporary directory is used and removed
+                    afterwards""")
+parser.add_argument('--no-spool', action='store_true',
+                    help="""skip the synthetic spool timings""")
+args = parser.parse_args()
+
+# Store arguments to variables for rest of the script
+n_hubs = args.hubs
+n_hits = args.hits
+n_repeat = args.repeat
+spool_hubs = args.spool_hubs
+spool_rate = args.rate
+spool_time = args.time
+spool_dir = args.datadir
+
+
+# Standard libraries
+import os, os.path
+import shutil, tempfile
+import time
+import random
+import resource
+import multiprocessing
+import numpy as np
+
+# Custom libraries
+from hsreader import Hit, HitStream, HubStream, HitFilter, load, write_h5
+from hsgenerator import generate_spool
+import daq_nicknames
+
+
+class ArgminHitStream:
+    """Time-sorted stream of hits from streams passed, merged by taking the
+    argmin over all buffered times for every hit (the original HitStream
+    implementation, kept for comparison)"""
+    def __init__(self, *streams):
+        self.streams = []
+        for stream in streams:
+            self.streams.append(stream)
+
+        # Buffer the first hit from each stream, and track its time
+        self.tophits = []
+        self.times = np.zeros(len(self.streams),'d')
+        for i in range(len(self.streams)):
+            self.tophits.append(self.streams[i].next())
+            self.times[i] = self.tophits[i].utc
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if len(self.times)==0:
+            raise StopIteration
+        earliest_index = np.argmin(self.times)
+        earliest_hit = self.tophits[earliest_index]
+        try:
+            self.tophits[earliest_index] = self.streams[earliest_index].next()
+            self.times[earliest_index] = self.tophits[earliest_index].utc
+        except StopIteration:
+            self.times = np.delete(self.times,earliest_index)
+            self.tophits.pop(earliest_index)
+            self.streams.pop(earliest_index)
+        return earliest_hit
+
+
+class ListStream:
+    """Stream of hits from a list, standing in for a HubStream"""
+    def __init__(self, hits):
+        self.hits = hits
+        self.index = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.index>=len(self.hits):
+            raise StopIteration
+        hit = self.hits[self.index]
+        self.index += 1
+        return hit
+
+
+def make_hub_hits(hub, n, seed):
+    """Returns list of n time-sorted synthetic hits for a hub. Times are kept
+    small enough to be exact as doubles, and are coarse enough to give ties
+    between hubs"""
+    rng = random.Random(seed)
+    omkey = str(hub).zfill(2)+"-01"
+    utc = 0
+    hits = []
+    for i in range(n):
+        utc += rng.randint(0, 40)*250
+        hits.append(Hit(omkey, utc, 0, 0))
+    return hits
+
+
+def time_stream(stream_class, hub_hits):
+    """Returns the time taken to merge the hub hits with stream_class, and
+    the merged hits"""
+    streams = [ListStream(hits) for hits in hub_hits]
+    start = time.time()
+    merged = list(stream_class(*streams))
+    return time.time()-start, merged
+
+
+def report(name, n, seconds, peak=None):
+    line = "%-24s %10d hits %8.3f s %12.0f hits/s" % (name, n, seconds,
+                                                      n/seconds)
+    if peak is not None:
+        line += " %8.1f MB peak" % peak
+    print(line)
+
+
+# Timings on the synthetic spool. Each takes the directory of the spool's
+# hitspool directories, and goes through all of its hits
+def hub_dirs(spool):
+    return [os.path.join(spool,item) for item in sorted(os.listdir(spool))]
+
+def time_raw(spool):
+    for hubdir in hub_dirs(spool):
+        stream = HubStream(hubdir)
+        try:
+            while True:
+                stream.nextRaw()
+        except StopIteration:
+            pass
+
+def time_decode(spool):
+    for hubdir in hub_dirs(spool):
+        stream = HubStream(hubdir)
+        try:
+            while True:
+                stream.nextBlock()
+        except StopIteration:
+            pass
+
+def time_merge_hits(spool):
+    for hit in HitStream(*[HubStream(hubdir) for hubdir in hub_dirs(spool)]):
+        pass
+
+def time_merge_blocks(spool):
+    for block in HitStream(*[HubStream(hubdir) for hubdir
+                             in hub_dirs(spool)], block_size=1<<16):
+        pass
+
+def time_hitfilter(spool):
+    hitfilter = HitFilter(lc=1, min_charge=100)
+    for block in HitStream(*[HubStream(hubdir, hitfilter) for hubdir
+                             in hub_dirs(spool)], block_size=1<<16):
+        pass
+
+def time_filter_function(spool):
+    hitfilter = lambda hit: hit.lc==1 and hit.charge_max>=100
+    for hit in HitStream(*[HubStream(hubdir, hitfilter) for hubdir
+                           in hub_dirs(spool)]):
+        pass
+
+def time_load_hits(spool):
+    load(spool, data_dir=spool, reuse_data=True)
+
+def time_load_array(spool):
+    load(spool, data_dir=spool, reuse_data=True, form="array")
+
+def time_write_h5(spool):
+    outfile = os.path.join(os.path.dirname(spool), "benchmark.h5")
+    write_h5(spool, outfile, data_dir=spool, reuse_data=True)
+    os.remove(outfile)
+
+def run_timing(timing, spool):
+    """Returns the time taken by a timing, and the peak memory (in MB) of
+    the process it ran in"""
+    start = time.time()
+    timing(spool)
+    seconds = time.time()-start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def spool_timings(spool, n_total):
+    timings = [("HubStream.nextRaw", time_raw),
+               ("HubStream.nextBlock", time_decode),
+               ("HitStream hits", time_merge_hits),
+               ("HitStream blocks", time_merge_blocks),
+               ("HitFilter blocks", time_hitfilter),
+               ("filter function hits", time_filter_function),
+               ("load hits", time_load_hits),
+               ("load array", time_load_array)]
+    try:
+        import tables
+    except ImportError:
+        print("pytables not found, skipping write_h5")
+    else:
+        timings.append(("write_h5", time_write_h5))
+
+    for name, timing in timings:
+        best = None
+        peak = 0
+        for i in range(n_repeat):
+            # Each timing gets a fresh process, so its peak memory is its own
+            pool = multiprocessing.Pool(1)
+            try:
+                seconds, memory = pool.apply(run_timing, (timing, spool))
+            finally:
+                pool.close()
+                pool.join()
+            if best is None or seconds<best:
+                best = seconds
+            peak = max(peak, memory)
+        report(name, n_total, best, peak)
+
+
+if not args.no_spool:
+    if spool_dir is None:
+        root = tempfile.mkdtemp()
+    else:
+        root = spool_dir
+    try:
+        spool = os.path.join(root, "spool")
+        nickname_file = os.path.join(root, "nicknames.txt")
+        hubdirs, n_total = generate_spool(spool, spool_hubs, spool_time,
+                                          spool_rate,
+                                          nickname_file=nickname_file)
+        daq_nicknames.set_nickname_file(nickname_file,
+                                        os.path.join(root, "cache"))
+        print("Timing synthetic spool of", spool_hubs, "hubs with", n_total,
+              "hits")
+        spool_timings(spool, n_total)
+    finally:
+        if spool_dir is None:
+            shutil.rmtree(root)
+    print()
+
+
+hub_hits = [make_hub_hits(hub+1, n_hits, hub) for hub in range(n_hubs)]
+n_total = n_hubs*n_hits
+print("Merging", n_hubs, "streams of", n_hits, "hits")
+
+results = {}
+for name, stream_class in (("argmin HitStream", ArgminHitStream),
+                           ("heap HitStream", HitStream)):
+    best = None
+    for i in range(n_repeat):
+        seconds, merged = time_stream(stream_class, hub_hits)
+        if best is None or seconds<best:
+            best = seconds
+    results[name] = merged
+    report(name, n_total, best)
+
+# Make sure both merges give the same ordering (including ties)
+same = all(a is b for a, b in zip(results["argmin HitStream"],
+                                  results["heap HitStream"]))
+print("Orderings match:", same)